@@ -0,0 +1,135 @@
+"""p99 задержки обнаружения и пропускная способность пакетирования: python benchmarks/bench_batching.py
+
+Сравнивается адаптивный MessageBatcher с прежней политикой (пакет 100 и опрос раз в секунду).
+Обработка пакета заменена паузой: фиксированная стоимость коммита плюс стоимость на сообщение.
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("ADMIN_ID", "42")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="tracker-bench-"))
+
+import main  # noqa: E402
+
+BATCH_COST = 0.003  # Коммит outbox на пакет (сек)
+MESSAGE_COST = 0.00005  # Сопоставление и рендер на сообщение (сек)
+LEGACY_BATCH_SIZE = 100
+LEGACY_POLL = 1.0
+
+# (название, темп сообщ./сек, длительность сек); темп 0 — пауза
+SCENARIOS = {
+    "low": [("low", 5, 6)],
+    "high": [("high", 2000, 3)],
+    "burst+lull": [("burst", 3000, 1), ("lull", 0, 2), ("trickle", 3, 3)],
+}
+
+
+async def fake_batch(batch):
+    await asyncio.sleep(BATCH_COST + MESSAGE_COST * len(batch))
+
+
+def arrivals(phases, seed=0):
+    """Моменты поступления (пуассоновский поток по фазам)"""
+    rng = random.Random(seed)
+    offset = 0.0
+    times = []
+    for _, rate, duration in phases:
+        if rate:
+            moment = offset
+            while True:
+                moment += rng.expovariate(rate)
+                if moment >= offset + duration:
+                    break
+                times.append(moment)
+        offset += duration
+    return times
+
+
+async def feed(times, put):
+    started = time.monotonic()
+    for moment in times:
+        delay = started + moment - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        put()
+
+
+async def run_adaptive(times):
+    latencies = []
+
+    async def measured_batch(batch):
+        await fake_batch(batch)
+        done = time.monotonic()
+        latencies.extend(done - enqueued for _, _, enqueued in batch)
+
+    main.process_message_batch = measured_batch
+    batcher = main.MessageBatcher()
+    task = asyncio.create_task(batcher.run())
+    started = time.monotonic()
+    await feed(times, lambda: batcher.put(555, None))
+    while len(latencies) < len(times):
+        await asyncio.sleep(0.001)
+    elapsed = time.monotonic() - started
+    task.cancel()
+    return latencies, elapsed
+
+
+async def run_legacy(times):
+    pending = []
+    latencies = []
+
+    async def flush():
+        batch = pending[:LEGACY_BATCH_SIZE]
+        del pending[:LEGACY_BATCH_SIZE]
+        await fake_batch(batch)
+        done = time.monotonic()
+        latencies.extend(done - enqueued for enqueued in batch)
+
+    def put():
+        pending.append(time.monotonic())
+        if len(pending) >= LEGACY_BATCH_SIZE:
+            asyncio.ensure_future(flush())
+
+    async def poll():
+        while True:
+            if pending:
+                await flush()
+            await asyncio.sleep(LEGACY_POLL)
+
+    task = asyncio.create_task(poll())
+    started = time.monotonic()
+    await feed(times, put)
+    while len(latencies) < len(times):
+        await asyncio.sleep(0.001)
+    elapsed = time.monotonic() - started
+    task.cancel()
+    return latencies, elapsed
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[max(0, int(len(values) * share) - 1)] if values else 0.0
+
+
+async def bench():
+    print(f"{'scenario':<12}{'policy':<10}{'msgs':>7}{'msg/s':>9}{'p50 ms':>9}{'p99 ms':>9}")
+    for name, phases in SCENARIOS.items():
+        times = arrivals(phases)
+        for policy, runner in (("adaptive", run_adaptive), ("legacy", run_legacy)):
+            latencies, elapsed = await runner(times)
+            print(
+                f"{name:<12}{policy:<10}{len(latencies):>7}{len(latencies) / elapsed:>9.0f}"
+                f"{percentile(latencies, 0.5) * 1000:>9.1f}{percentile(latencies, 0.99) * 1000:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
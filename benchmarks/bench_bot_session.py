@@ -0,0 +1,112 @@
+"""Сессия Bot API по умолчанию против режима производительности: python benchmarks/bench_bot_session.py
+
+Bot API подменяется локальным aiohttp-сервером, отвечающим на sendMessage, поэтому измеряется
+только клиентская сторона: сериализация, пул соединений и цикл событий.
+С установленным uvloop режим производительности запускается еще и в нем.
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("ADMIN_ID", "42")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="tracker-bench-"))
+
+from aiohttp import web  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.enums import ParseMode  # noqa: E402
+
+import main  # noqa: E402
+
+MESSAGES = 2000
+CONCURRENCY = 50
+PORT = 18081
+TEXT = "<b>🔔 Обнаружено ключевое слово!</b>\n" + "Текст сообщения с контекстом. " * 25
+
+RESPONSE = json.dumps({"ok": True, "result": {
+    "message_id": 1, "date": 0, "chat": {"id": 42, "type": "private"}, "text": "ok",
+}})
+
+
+async def send_message(request: web.Request) -> web.Response:
+    await request.read()
+    return web.Response(text=RESPONSE, content_type="application/json")
+
+
+async def start_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_post("/bot{token}/sendMessage", send_message)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    return runner
+
+
+async def measure(session: AiohttpSession) -> float:
+    runner = await start_server()
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=session)
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def send():
+        async with semaphore:
+            await bot.send_message(chat_id=42, text=TEXT, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+
+    await send()  # Прогрев пула соединений
+    started = time.perf_counter()
+    await asyncio.gather(*(send() for _ in range(MESSAGES)))
+    elapsed = time.perf_counter() - started
+    await bot.session.close()
+    await runner.cleanup()
+    return MESSAGES / elapsed
+
+
+def run_case(name: str, perf: bool, loop_factory=None):
+    api = TelegramAPIServer.from_base(f"http://127.0.0.1:{PORT}")
+    main.PERF_MODE = perf
+
+    async def case():
+        session = main.create_bot_session(api=api) if perf else AiohttpSession(api=api)
+        return await measure(session)
+
+    if loop_factory is None:
+        rate = asyncio.run(case())
+    else:
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            rate = runner.run(case())
+    print(f"{name:<28}{rate:>10.0f} sendMessage/сек")
+
+
+def bench_json():
+    payload = {"chat_id": 42, "text": TEXT, "parse_mode": "HTML", "reply_markup": {
+        "inline_keyboard": [[{"text": "Перейти к сообщению", "url": "https://t.me/c/1/2"}]]}}
+    cases = [("json.dumps", lambda: json.dumps(payload))]
+    try:
+        import orjson
+    except ImportError:
+        print("orjson не установлен")
+    else:
+        cases.append(("orjson.dumps", lambda: orjson.dumps(payload).decode()))
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=20000, repeat=5)) / 20000
+        print(f"{name:<28}{best * 1e6:>10.2f} мкс/вызов")
+
+
+if __name__ == "__main__":
+    bench_json()
+    run_case("default session", perf=False)
+    run_case("PERF_MODE session", perf=True)
+    try:
+        import uvloop
+    except ImportError:
+        print("uvloop не установлен, вариант с uvloop пропущен")
+    else:
+        run_case("PERF_MODE session + uvloop", perf=True, loop_factory=uvloop.new_event_loop)
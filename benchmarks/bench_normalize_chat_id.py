@@ -0,0 +1,39 @@
+"""Сравнение арифметической нормализации ID чата со строковой: python benchmarks/bench_normalize_chat_id.py"""
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("ADMIN_ID", "42")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="tracker-bench-"))
+
+from main import CHANNEL_ID_OFFSET, normalize_chat_id  # noqa: E402
+
+
+def normalize_chat_id_str(chat_id: int) -> int:
+    """Прежняя реализация через строки"""
+    if str(chat_id).startswith('-100'):
+        return int(str(chat_id)[4:])
+    return chat_id
+
+
+def main():
+    rng = random.Random(0)
+    # Поток апдейтов: в основном супергруппы, немного обычных групп и личных сообщений
+    ids = [-(CHANNEL_ID_OFFSET + rng.randint(1, 10**10)) for _ in range(8000)]
+    ids += [-rng.randint(1, 10**9) for _ in range(1000)]
+    ids += [rng.randint(1, 10**10) for _ in range(1000)]
+    rng.shuffle(ids)
+
+    for name, func in (("arithmetic", normalize_chat_id), ("string", normalize_chat_id_str)):
+        best = min(timeit.repeat(lambda: [func(chat_id) for chat_id in ids], number=100, repeat=5))
+        print(f"{name:>10}: {best / (100 * len(ids)) * 1e9:7.1f} ns/call")
+
+
+if __name__ == "__main__":
+    main()
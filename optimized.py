@@ -2,13 +2,36 @@ import os
 import asyncio
 import logging
 import re
+import time
+import math
+import json
+import cProfile
+import gzip
+import zlib
+import shutil
+import argparse
+import signal
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+import csv
+import codecs
+import tempfile
+import weakref
+from contextlib import asynccontextmanager, suppress
+from types import SimpleNamespace
+from typing import NewType
 import aiosqlite
 from telethon import TelegramClient, events
-from telethon.tl.types import Channel
-from aiogram import Bot, Dispatcher, types
+from telethon.tl.types import Channel, PeerChannel, PeerChat
+from aiohttp import web
+from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.types import FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup
 import html
 from dotenv import load_dotenv
 
@@ -28,11 +51,121 @@ ADMIN_ID = int(os.getenv('ADMIN_ID'))
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
+# Режим производительности: uvloop, настроенный пул соединений Bot API и orjson (если установлены)
+
+PERF_MODE = os.getenv('PERF_MODE', '').lower() in ('1', 'true', 'yes')
+
+BOT_CONNECTION_LIMIT = 50  # Максимум одновременных соединений с Bot API в режиме производительности
+
+BOT_KEEPALIVE_TIMEOUT = 60  # Время жизни простаивающего keep-alive соединения (сек)
+
+# Профилирование стадий обработки: структурная запись в лог для медленных сообщений
+
+PROFILE_STAGES = os.getenv('PROFILE_STAGES', '').lower() in ('1', 'true', 'yes')
+
+SLOW_STAGE_THRESHOLD = float(os.getenv('SLOW_STAGE_THRESHOLD_MS', '100')) / 1000
+
+PROFILE_DIR = 'profiles'  # Куда сохраняются дампы /profile
+
+PROFILE_MAX_SECONDS = 300  # Максимальная длительность записи /profile (сек)
+
+# Запись входящих сообщений для воспроизведения (`python main.py --replay <файл>`)
+
+RECORD_FILE = os.getenv('RECORD_FILE', '')
+
+RECORD_ALL_CHATS = os.getenv('RECORD_ALL_CHATS', '').lower() in ('1', 'true', 'yes')  # Не только отслеживаемые чаты
+
+RECORD_FLUSH_EVERY = 100  # Записей между сбросами буфера gzip на диск
+
 SESSION_NAME = 'userbot_session'
 
 DB_NAME = 'tracker.db'
 
-BATCH_SIZE = 100  # Размер пакета для групповой обработки
+BATCH_MAX_SIZE = 100  # Максимальный размер пакета для групповой обработки
+
+BATCH_MAX_WAIT = 0.25  # Максимальное ожидание (сек) первого сообщения в пакете
+
+BATCH_RATE_TIME_CONSTANT = 0.5  # Постоянная времени сглаживания темпа поступления (сек)
+
+BATCH_IDLE_GAPS = 4  # Пауза в столько средних интервалов между сообщениями — поток прервался, пакет уходит
+
+BATCH_MIN_IDLE_GAP = 0.005  # Нижняя граница такой паузы (сек)
+
+BATCH_STATS_INTERVAL = 60  # Период логирования пропускной способности и задержек (сек)
+
+BATCH_RETRY_DELAY = 1.0  # Пауза (сек) перед повтором пакета, который не удалось записать
+
+BATCH_RETRY_MAX_DELAY = 30.0  # Предел паузы при повторных неудачах записи пакета
+
+IMPORT_CHUNK_SIZE = 1000  # Ключевых слов в одной транзакции при импорте
+
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # Лимит Bot API на скачивание файлов
+
+OUTBOX_DRAIN_LIMIT = 200  # Уведомлений из outbox за один проход отправителя
+
+OUTBOX_MAX_ATTEMPTS = 5  # Попыток отправки, после которых уведомление откладывается
+
+OUTBOX_RETRY_DELAY = 5  # Пауза (сек) после неудачных отправок
+
+OUTBOX_RETENTION = 24 * 3600  # Сколько хранить отправленные записи для идемпотентности
+
+CATCHUP_CONCURRENCY = 4  # Чатов, догоняемых одновременно после простоя
+
+CATCHUP_LIMIT = 2000  # Максимум пропущенных сообщений на чат
+
+MESSAGE_RETRY_LIMIT = 5  # Повторов сообщения, уведомление о котором не удалось подготовить
+
+MESSAGE_RETRY_DELAY = 1.0  # Пауза (сек) перед первым повтором, дальше удваивается
+
+CONNECTION_CHECK_INTERVAL = 30  # Период проверки соединения userbot (сек)
+
+HIT_CACHE_SIZE = 20000  # Сообщений в кэше для инкрементальной проверки правок
+
+STATS_WINDOW = 300  # Скользящее окно статистики /chat_stats (сек, по секундным ячейкам)
+
+HOT_CHAT_SHARE = 0.3  # Доля нагрузки, начиная с которой чат помечается как "горячий"
+
+MAX_FUZZY_DISTANCE = 2  # Максимальное расстояние Левенштейна для нечеткого поиска
+
+ANALYTICS_FLUSH_INTERVAL = 60  # Период сброса счетчиков ключевых слов в базу (сек)
+
+KEYWORD_HITS_RETENTION = 90 * 24  # Сколько часов хранить почасовую статистику ключевых слов
+
+CLEANUP_INTERVAL = 3600  # Период очистки осиротевших строк и инкрементального VACUUM (сек)
+
+CLEANUP_VACUUM_PAGES = 1000  # Страниц, освобождаемых за один проход incremental_vacuum
+
+SHUTDOWN_TIMEOUT = 20  # Максимум (сек) на дообработку очереди и отправку уведомлений при остановке
+
+# Локальные HTTP-проверки состояния для оркестратора (порт не задан — выключены)
+
+HEALTH_PORT = int(os.getenv('HEALTH_PORT') or 0)
+
+HEALTH_HOST = '127.0.0.1'
+
+HEALTH_SAMPLE_INTERVAL = 0.5  # Период замера задержки цикла событий (сек)
+
+HEALTH_LAG_WINDOW = 60  # Окно (сек), по которому берется максимальная задержка цикла
+
+HEALTH_MAX_LOOP_LAG = 1.0  # Задержка цикла (сек), начиная с которой состояние деградировано
+
+HEALTH_MAX_UPDATE_AGE = 900  # Сколько (сек) userbot может не получать апдейтов
+
+HEALTH_MAX_SEND_AGE = 300  # Сколько (сек) бот может не отправлять при непустом outbox
+
+HEALTH_MAX_QUEUE = 5000  # Предельная длина очереди пакетирования
+
+LIST_PAGE_SIZE = 10  # Чатов на странице /list
+
+KEYWORDS_PAGE_SIZE = 40  # Ключевых слов на странице списка чата
+
+ALBUM_WAIT = 0.5  # Ожидание (сек) остальных частей альбома после первой
+
+ALBUM_MAX_PARTS = 10  # Максимум частей в альбоме Telegram
+
+EXCERPT_LIMIT = 800  # Максимальная длина фрагмента сообщения в уведомлении
+
+EXCERPT_CONTEXT = 120  # Символов контекста вокруг каждого совпадения
 
 
 
@@ -54,31 +187,324 @@ logger = logging.getLogger(__name__)
 
 userbot = TelegramClient(SESSION_NAME, API_ID, API_HASH)
 
-bot = Bot(token=BOT_TOKEN)
+class TunedAiohttpSession(AiohttpSession):
+
+    """Сессия Bot API с настроенным keep-alive пула соединений"""
+
+    def __init__(self, keepalive_timeout: float, **kwargs):
+
+        super().__init__(**kwargs)
+
+        # Параметры коннектора aiogram хранит во внутреннем словаре: зависимость от него изолирована здесь
+
+        connector_init = getattr(self, "_connector_init", None)
+
+        if isinstance(connector_init, dict):
+
+            connector_init["keepalive_timeout"] = keepalive_timeout
+
+        else:
+
+            logger.warning("Не удалось настроить keep-alive сессии Bot API, используются настройки aiohttp")
+
+
+
+def create_bot_session(**kwargs) -> AiohttpSession | None:
+
+    """Сессия Bot API для режима производительности (None — настройки aiogram по умолчанию)"""
+
+    if not PERF_MODE:
+
+        return None
+
+    json_options = {}
+
+    try:
+
+        import orjson
+
+    except ImportError:
+
+        logger.info("orjson не установлен, используется стандартный json")
+
+    else:
+
+        json_options = {
+
+            "json_loads": orjson.loads,
+
+            "json_dumps": lambda obj: orjson.dumps(obj).decode(),
+
+        }
+
+    # По умолчанию aiohttp закрывает простаивающие соединения через 15 сек
+
+    return TunedAiohttpSession(
+
+        keepalive_timeout=BOT_KEEPALIVE_TIMEOUT, limit=BOT_CONNECTION_LIMIT, **json_options, **kwargs
+
+    )
+
+
+
+bot = Bot(token=BOT_TOKEN, session=create_bot_session())
 
 dp = Dispatcher()
 
 
 
+# Канонический ID чата: "голый" ID канала без префикса -100.
+# В таком виде ID хранится в БД, в кэше и используется в ссылках t.me/c/...
+
+ChatId = NewType("ChatId", int)
+
+
+
 # Глобальное хранилище для кэширования
 
-tracked_chats = {}  # {chat_id: {"title": "", "username": "", "pattern": regex}}
+class TrackedChat:
+    """Запись об отслеживаемом чате"""
+    __slots__ = ("chat_id", "title", "username", "pattern", "fuzzy", "chat_link", "message_link_prefix")
+
+    def __init__(self, chat_id: ChatId, title: str, username: str = "", pattern=None):
+        self.chat_id = chat_id
+        self.title = title
+        self.username = username or ""
+        self.pattern = pattern
+        self.fuzzy = None  # FuzzyIndex для ключевых слов с нечетким поиском
+        # Ссылки считаются один раз при добавлении чата, а не на каждое совпадение
+        if self.username:
+            self.chat_link = f"https://t.me/{self.username}"
+            self.message_link_prefix = f"https://t.me/{self.username}/"
+        else:
+            self.chat_link = ""
+            self.message_link_prefix = f"https://t.me/c/{abs(chat_id)}/"
+
+
+class ChatRegistry:
+    """Реестр отслеживаемых чатов по нормализованному ID"""
+    __slots__ = ("_chats",)
+
+    def __init__(self):
+        self._chats: dict[ChatId, TrackedChat] = {}
+
+    def add(self, chat: TrackedChat) -> TrackedChat:
+        self._chats[chat.chat_id] = chat
+        return chat
+
+    def remove(self, chat_id: ChatId) -> TrackedChat | None:
+        return self._chats.pop(chat_id, None)
+
+    def get(self, chat_id: ChatId) -> TrackedChat | None:
+        return self._chats.get(chat_id)
+
+    def set_pattern(self, chat_id: ChatId, pattern) -> None:
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            chat.pattern = pattern
+
+    def set_fuzzy(self, chat_id: ChatId, fuzzy) -> None:
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            chat.fuzzy = fuzzy
+
+    def __contains__(self, chat_id: ChatId) -> bool:
+        return chat_id in self._chats
+
+    def __iter__(self):
+        return iter(self._chats.values())
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+
+tracked_chats = ChatRegistry()  # {ChatId: TrackedChat}
+
+last_seen_ids: dict[ChatId, int] = {}  # Последний обработанный message_id по чатам
+
+
+
+class HitCache:
+    """Ограниченный LRU-кэш последних сообщений: хэш текста и найденные слова"""
+    __slots__ = ("_entries", "_capacity")
+
+    def __init__(self, capacity: int):
+        self._entries: OrderedDict[tuple[ChatId, int], tuple[int, frozenset]] = OrderedDict()
+        self._capacity = capacity
+
+    def get(self, chat_id: ChatId, message_id: int) -> tuple[int, frozenset] | None:
+        return self._entries.get((chat_id, message_id))
+
+    def put(self, chat_id: ChatId, message_id: int, text_hash: int, keywords: frozenset) -> None:
+        key = (chat_id, message_id)
+        self._entries[key] = (text_hash, keywords)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+
+hit_cache = HitCache(HIT_CACHE_SIZE)
+
+
+
+class ChatStats:
+    """Скользящие счетчики чата: кольцевые буферы по секундам за STATS_WINDOW"""
+    __slots__ = ("seen", "hits", "match_time", "stamps")
+
+    def __init__(self):
+        self.seen = array('I', [0]) * STATS_WINDOW
+        self.hits = array('I', [0]) * STATS_WINDOW
+        self.match_time = array('d', [0.0]) * STATS_WINDOW
+        self.stamps = array('q', [0]) * STATS_WINDOW  # Секунда, к которой относится ячейка
+
+    def slot(self) -> int:
+        """Ячейка текущей секунды"""
+        second = int(time.monotonic())
+        index = second % STATS_WINDOW
+        if self.stamps[index] != second:
+            # Ячейка осталась от прошлого круга — обнуляем
+            self.stamps[index] = second
+            self.seen[index] = 0
+            self.hits[index] = 0
+            self.match_time[index] = 0.0
+        return index
+
+    def record_arrival(self):
+        # Каждое поступившее сообщение, включая медиа без текста и правки без изменений
+        self.seen[self.slot()] += 1
+
+    def record_match(self, hit: bool, match_seconds: float):
+        index = self.slot()
+        if hit:
+            self.hits[index] += 1
+        self.match_time[index] += match_seconds
+
+    def totals(self) -> tuple[int, int, float]:
+        """Сообщения, совпадения и время матчинга за окно"""
+        oldest = int(time.monotonic()) - STATS_WINDOW
+        seen = hits = 0
+        match_time = 0.0
+        for index, stamp in enumerate(self.stamps):
+            if stamp > oldest:
+                seen += self.seen[index]
+                hits += self.hits[index]
+                match_time += self.match_time[index]
+        return seen, hits, match_time
+
+
+class KeywordCounters:
+    """Счетчики срабатываний (час, чат, ключевое слово) в памяти со сбросом пачкой"""
+    __slots__ = ("counts",)
+
+    def __init__(self):
+        self.counts: dict[tuple[int, ChatId, str], int] = {}
+
+    def add(self, chat_id: ChatId, keywords):
+        bucket = int(time.time()) // 3600
+        counts = self.counts
+        for keyword in keywords:
+            key = (bucket, chat_id, keyword)
+            counts[key] = counts.get(key, 0) + 1
+
+    async def flush(self):
+        """Один пакетный upsert накопленных счетчиков"""
+        if not self.counts:
+            return
+        # Подмена словаря до await: новые срабатывания копятся уже в следующем
+        counts, self.counts = self.counts, {}
+        try:
+            async with db_connect() as db:
+                await db.executemany(
+                    'INSERT INTO keyword_hits (bucket, chat_id, keyword, hits) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(bucket, chat_id, keyword) DO UPDATE SET hits = hits + excluded.hits',
+                    [(bucket, chat_id, keyword, hits) for (bucket, chat_id, keyword), hits in counts.items()]
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения статистики ключевых слов: {e}")
+            # Возвращаем несохраненное, чтобы не потерять при следующем сбросе
+            for key, hits in counts.items():
+                self.counts[key] = self.counts.get(key, 0) + hits
+
+keyword_counters = KeywordCounters()
+
+async def analytics_flusher():
+    """Периодический сброс счетчиков ключевых слов"""
+    while True:
+        await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL)
+        await keyword_counters.flush()
+
+
+chat_stats: dict[ChatId, ChatStats] = {}  # Статистика по нормализованным ID чатов
+
+def get_chat_stats(chat_id: ChatId) -> ChatStats:
+    stats = chat_stats.get(chat_id)
+    if stats is None:
+        stats = chat_stats[chat_id] = ChatStats()
+    return stats
+
+
 
-pending_messages = []  # Буфер для пакетной обработки сообщений
+# Marked ID каналов и супергрупп: -(10**12 + id), обычных групп: -id, пользователей: id.
+# Нормализованный ID канала совпадает с ID пользователя с тем же числом, поэтому
+# обработчики апдейтов отсекают личные чаты (marked ID > 0) до поиска в tracked_chats
 
+CHANNEL_ID_OFFSET = 1_000_000_000_000
 
 
-def normalize_chat_id(chat_id: int) -> int:
+
+def normalize_chat_id(chat_id: int) -> ChatId:
 
     """Нормализация ID чата для сравнения"""
 
-    if str(chat_id).startswith('-100'):
+    # Только арифметика: выполняется на каждом входящем апдейте
+
+    if chat_id < -CHANNEL_ID_OFFSET:
+
+        # Канал/супергруппа: -100XXXXXXXXXX -> XXXXXXXXXX
+
+        return ChatId(-chat_id - CHANNEL_ID_OFFSET)
+
+    # Обычные группы остаются отрицательными, пользователи и "голые" ID каналов — как есть
+
+    return ChatId(chat_id)
+
+
+
+@asynccontextmanager
+async def db_connect():
+    """Соединение с базой с включенными внешними ключами (иначе ON DELETE CASCADE не работает)"""
+    async with aiosqlite.connect(DB_NAME) as db:
+        await db.execute('PRAGMA foreign_keys = ON')
+        yield db
+
+@asynccontextmanager
+async def db_transaction():
+    """Многошаговое изменение одной транзакцией: commit при успехе, rollback при ошибке"""
+    async with db_connect() as db:
+        await db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+
+class ChatLocks:
+    """Асинхронные блокировки по чатам для изменений из админских команд"""
+    __slots__ = ("_locks",)
 
-        # Убираем префикс '-100' из chat_id
+    def __init__(self):
+        # Блокировка живет, пока ее кто-то держит или ждет
+        self._locks: weakref.WeakValueDictionary[ChatId, asyncio.Lock] = weakref.WeakValueDictionary()
 
-        return int(str(chat_id)[4:])
+    def get(self, chat_id: ChatId) -> asyncio.Lock:
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        return lock
 
-    return chat_id
+chat_locks = ChatLocks()
 
 
 
@@ -86,7 +512,7 @@ async def init_db():
 
     """Инициализация базы данных"""
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with db_connect() as db:
 
         await db.execute('''
 
@@ -120,199 +546,704 @@ async def init_db():
 
         await db.execute('CREATE INDEX IF NOT EXISTS idx_chat_id ON keywords(chat_id)')
 
-        await db.commit()
+        # Уникальность (chat_id, keyword), чтобы INSERT OR IGNORE отсекал дубли при импорте
 
+        cursor = await db.execute(
 
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_keywords_unique'"
 
-async def load_tracked_data():
+        )
 
-    """Загрузка данных из базы в память"""
+        if await cursor.fetchone() is None:
 
-    async with aiosqlite.connect(DB_NAME) as db:
+            await db.execute(
 
-        # Загрузка чатов
+                'DELETE FROM keywords WHERE id NOT IN (SELECT MIN(id) FROM keywords GROUP BY chat_id, keyword)'
 
-        cursor = await db.execute('SELECT id, title, username FROM chats')
+            )
 
-        chat_rows = await cursor.fetchall()
+            await db.execute('CREATE UNIQUE INDEX idx_keywords_unique ON keywords(chat_id, keyword)')
 
-        for row in chat_rows:
+        # Допустимое расстояние Левенштейна для ключевого слова (0 — только точное совпадение)
 
-            chat_id, title, username = row
+        cursor = await db.execute('PRAGMA table_info(keywords)')
 
-            tracked_chats[chat_id] = {
+        if 'fuzzy' not in [row[1] for row in await cursor.fetchall()]:
 
-                "title": title,
+            await db.execute('ALTER TABLE keywords ADD COLUMN fuzzy INTEGER NOT NULL DEFAULT 0')
 
-                "username": username,
+        # Получатели уведомлений: чат и (необязательно) тема форума, 0 — без темы
 
-                "pattern": None
+        await db.execute('''
 
-            }
+            CREATE TABLE IF NOT EXISTS destinations (
 
-        
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
 
-        # Загрузка ключевых слов и компиляция regex
+                chat_id INTEGER NOT NULL,
 
-        cursor = await db.execute('SELECT chat_id, GROUP_CONCAT(keyword) FROM keywords GROUP BY chat_id')
+                thread_id INTEGER NOT NULL DEFAULT 0,
 
-        keyword_rows = await cursor.fetchall()
+                UNIQUE(chat_id, thread_id)
 
-        for chat_id, keywords_str in keyword_rows:
+            )
 
-            if chat_id in tracked_chats and keywords_str:
+        ''')
 
-                try:
+        # Правила маршрутизации: NULL в source_chat_id/keyword означает "любой"
 
-                    # Экранирование и компиляция regex
+        await db.execute('''
 
-                    escaped_keywords = [re.escape(kw.strip().lower()) for kw in keywords_str.split(',')]
+            CREATE TABLE IF NOT EXISTS routes (
 
-                    pattern_str = r'\b(' + '|'.join(escaped_keywords) + r')\b'
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
 
-                    tracked_chats[chat_id]["pattern"] = re.compile(pattern_str, re.IGNORECASE)
+                destination_id INTEGER NOT NULL,
 
-                    logger.info(f"Скомпилирован regex для чата {chat_id}: {pattern_str}")
+                source_chat_id INTEGER,
 
-                except Exception as e:
+                keyword TEXT,
 
-                    logger.error(f"Ошибка компиляции regex для чата {chat_id}: {e}")
+                FOREIGN KEY(destination_id) REFERENCES destinations(id) ON DELETE CASCADE
 
+            )
 
+        ''')
 
-async def add_chat(chat_id: int, title: str, username: str = ""):
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_routes_destination ON routes(destination_id)')
 
-    """Добавление чата в базу"""
+        # Outbox: уведомления пишутся сюда до отправки и переживают перезапуск
 
-    normalized_id = normalize_chat_id(chat_id)
+        await db.execute('''
 
-    async with aiosqlite.connect(DB_NAME) as db:
+            CREATE TABLE IF NOT EXISTS outbox (
+
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+
+                source_chat_id INTEGER NOT NULL,
+
+                message_id INTEGER NOT NULL,
+
+                target_id INTEGER NOT NULL,
+
+                thread_id INTEGER NOT NULL DEFAULT 0,
+
+                text TEXT NOT NULL,
+
+                link TEXT NOT NULL,
+
+                created_at REAL NOT NULL,
+
+                attempts INTEGER NOT NULL DEFAULT 0,
+
+                sent_at REAL,
+
+                revision INTEGER NOT NULL DEFAULT 0
+
+            )
+
+        ''')
+
+        # Миграция outbox без номера правки: ключ идемпотентности расширяется ревизией
+
+        cursor = await db.execute('PRAGMA table_info(outbox)')
+
+        if 'revision' not in [row[1] for row in await cursor.fetchall()]:
+
+            await db.execute('ALTER TABLE outbox ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+
+        await db.execute('DROP INDEX IF EXISTS idx_outbox_key')
+
+        # Ключ идемпотентности: одно уведомление на сообщение (его правку) и получателя
 
         await db.execute(
 
-            'INSERT OR IGNORE INTO chats (id, title, username) VALUES (?, ?, ?)',
+            'CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_key_rev '
 
-            (normalized_id, title, username)
+            'ON outbox(source_chat_id, message_id, revision, target_id, thread_id)'
 
         )
 
-        await db.commit()
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_outbox_unsent ON outbox(id) WHERE sent_at IS NULL')
 
-    # Обновление кэша
+        # Почасовые агрегаты срабатываний ключевых слов
 
-    tracked_chats[normalized_id] = {"title": title, "username": username, "pattern": None}
+        await db.execute('''
 
+            CREATE TABLE IF NOT EXISTS keyword_hits (
 
+                bucket INTEGER NOT NULL,
 
-async def remove_chat(chat_id: int):
+                chat_id INTEGER NOT NULL,
 
-    """Удаление чата из базы"""
+                keyword TEXT NOT NULL,
 
-    normalized_id = normalize_chat_id(chat_id)
+                hits INTEGER NOT NULL,
 
-    async with aiosqlite.connect(DB_NAME) as db:
+                PRIMARY KEY(bucket, chat_id, keyword)
 
-        await db.execute('DELETE FROM chats WHERE id = ?', (normalized_id,))
+            )
 
-        await db.commit()
+        ''')
 
-    # Обновление кэша
+        # Блокировка и разрешение отправителей: по чатам и глобально (chat_id = 0)
 
-    if normalized_id in tracked_chats:
+        await db.execute('''
 
-        del tracked_chats[normalized_id]
+            CREATE TABLE IF NOT EXISTS sender_filters (
 
+                chat_id INTEGER NOT NULL,
 
+                sender_id INTEGER NOT NULL,
 
-async def add_keywords(chat_id: int, keywords: list):
+                mode TEXT NOT NULL CHECK(mode IN ('block', 'allow')),
 
-    """Добавление ключевых слов"""
+                PRIMARY KEY(chat_id, sender_id)
 
-    normalized_id = normalize_chat_id(chat_id)
+            )
 
-    async with aiosqlite.connect(DB_NAME) as db:
+        ''')
 
-        # Пакетная вставка
+        # Последнее обработанное сообщение в каждом чате для догона после простоя
 
-        data = [(normalized_id, kw.strip().lower()) for kw in keywords]
+        await db.execute('''
 
-        await db.executemany(
+            CREATE TABLE IF NOT EXISTS chat_state (
 
-            'INSERT OR IGNORE INTO keywords (chat_id, keyword) VALUES (?, ?)',
+                chat_id INTEGER PRIMARY KEY,
 
-            data
+                last_message_id INTEGER NOT NULL
 
-        )
+            )
+
+        ''')
 
         await db.commit()
 
-    # Перезагрузка regex
+        # Инкрементальный VACUUM требует auto_vacuum = INCREMENTAL; существующую базу переводим один раз
 
-    await reload_regex(normalized_id)
+        cursor = await db.execute('PRAGMA auto_vacuum')
 
+        (auto_vacuum,) = await cursor.fetchone()
 
+        if auto_vacuum != 2:
 
-async def remove_keywords(chat_id: int, keywords: list):
+            await db.execute('PRAGMA auto_vacuum = INCREMENTAL')
 
-    """Удаление ключевых слов"""
+            await db.execute('VACUUM')
 
-    normalized_id = normalize_chat_id(chat_id)
 
-    async with aiosqlite.connect(DB_NAME) as db:
 
-        placeholders = ','.join(['?'] * len(keywords))
+async def load_tracked_data():
 
-        await db.execute(
+    """Загрузка данных из базы в память"""
 
-            f'DELETE FROM keywords WHERE chat_id = ? AND keyword IN ({placeholders})',
+    async with db_connect() as db:
 
-            (normalized_id, *[kw.strip().lower() for kw in keywords])
+        # Загрузка чатов
 
-        )
+        cursor = await db.execute('SELECT id, title, username FROM chats')
 
-        await db.commit()
-    # Перезагрузка regex
-    await reload_regex(normalized_id)
+        chat_rows = await cursor.fetchall()
+
+        for row in chat_rows:
+
+            chat_id, title, username = row
+
+            tracked_chats.add(TrackedChat(ChatId(chat_id), title, username))
+
+        
+
+        # Загрузка ключевых слов и компиляция regex
+
+        cursor = await db.execute('SELECT chat_id, GROUP_CONCAT(keyword) FROM keywords GROUP BY chat_id')
+
+        keyword_rows = await cursor.fetchall()
+
+        for chat_id, keywords_str in keyword_rows:
+
+            if chat_id in tracked_chats and keywords_str:
+
+                try:
+
+                    # Экранирование и компиляция regex
+
+                    escaped_keywords = [re.escape(kw.strip().lower()) for kw in keywords_str.split(',')]
+
+                    pattern_str = r'\b(' + '|'.join(escaped_keywords) + r')\b'
+
+                    tracked_chats.set_pattern(chat_id, re.compile(pattern_str, re.IGNORECASE))
+
+                    logger.info(f"Скомпилирован regex для чата {chat_id}: {pattern_str}")
+
+                except Exception as e:
+
+                    logger.error(f"Ошибка компиляции regex для чата {chat_id}: {e}")
+
+        # Индексы нечеткого поиска
+
+        cursor = await db.execute('SELECT chat_id, keyword, fuzzy FROM keywords WHERE fuzzy > 0')
+
+        fuzzy_keywords = {}
+
+        async for chat_id, keyword, distance in cursor:
+
+            fuzzy_keywords.setdefault(chat_id, []).append((keyword, distance))
+
+        for chat_id, keywords in fuzzy_keywords.items():
+
+            tracked_chats.set_fuzzy(chat_id, FuzzyIndex(keywords))
+
+
+
+async def add_chat(chat_id: int, title: str, username: str = ""):
+    """Добавление чата в базу"""
+    normalized_id = normalize_chat_id(chat_id)
+    async with chat_locks.get(normalized_id):
+        async with db_transaction() as db:
+            await db.execute(
+                'INSERT OR IGNORE INTO chats (id, title, username) VALUES (?, ?, ?)',
+                (normalized_id, title, username)
+            )
+        # Обновление кэша
+        tracked_chats.add(TrackedChat(normalized_id, title, username))
+        notification_templates.pop(normalized_id, None)
+        # Ключевые слова могли остаться в базе от прошлого добавления
+        await reload_regex(normalized_id)
+
+async def remove_chat(chat_id: int):
+    """Удаление чата из базы"""
+    normalized_id = normalize_chat_id(chat_id)
+    async with chat_locks.get(normalized_id):
+        async with db_transaction() as db:
+            # Ключевые слова удаляются каскадно (foreign_keys включены в db_connect)
+            await db.execute('DELETE FROM chats WHERE id = ?', (normalized_id,))
+            await db.execute('DELETE FROM routes WHERE source_chat_id = ?', (normalized_id,))
+            await db.execute('DELETE FROM chat_state WHERE chat_id = ?', (normalized_id,))
+            await db.execute('DELETE FROM sender_filters WHERE chat_id = ?', (normalized_id,))
+        # Обновление кэша
+        tracked_chats.remove(normalized_id)
+        notification_templates.pop(normalized_id, None)
+        chat_stats.pop(normalized_id, None)
+        last_seen_ids.pop(normalized_id, None)
+    await load_routes()
+    await load_sender_filters()
+
+async def add_keywords(chat_id: int, keywords: list):
+    """Добавление ключевых слов"""
+    normalized_id = normalize_chat_id(chat_id)
+    async with chat_locks.get(normalized_id):
+        async with db_transaction() as db:
+            # Пакетная вставка
+            data = [(normalized_id, kw.strip().lower()) for kw in keywords]
+            await db.executemany(
+                'INSERT OR IGNORE INTO keywords (chat_id, keyword) VALUES (?, ?)',
+                data
+            )
+        # Перезагрузка regex
+        await reload_regex(normalized_id)
+
+async def remove_keywords(chat_id: int, keywords: list):
+    """Удаление ключевых слов"""
+    normalized_id = normalize_chat_id(chat_id)
+    async with chat_locks.get(normalized_id):
+        async with db_transaction() as db:
+            placeholders = ','.join(['?'] * len(keywords))
+            await db.execute(
+                f'DELETE FROM keywords WHERE chat_id = ? AND keyword IN ({placeholders})',
+                (normalized_id, *[kw.strip().lower() for kw in keywords])
+            )
+        # Перезагрузка regex
+        await reload_regex(normalized_id)
+
+def parse_keyword_line(line: str, first: bool = False) -> str | None:
+    """Ключевое слово из строки TXT/CSV-файла (первая колонка); first — первая строка, возможен заголовок"""
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    fields = next(csv.reader((line,)), None)
+    keyword = fields[0].strip().lower() if fields else ""
+    # Запятая — разделитель ключевых слов в командах и в GROUP_CONCAT
+    if not keyword or "," in keyword:
+        return None
+    # Заголовок CSV из /export_keywords; в остальных строках "keyword" — обычное слово
+    if first and keyword == "keyword":
+        return None
+    return keyword
+
+async def iter_document_lines(file_path: str):
+    """Построчное чтение файла из Telegram без загрузки его целиком в память"""
+    url = bot.session.api.file_url(bot.token, file_path)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    tail = ""
+    async for chunk in bot.session.stream_content(url=url, timeout=60):
+        tail += decoder.decode(chunk)
+        *lines, tail = tail.split("\n")
+        for line in lines:
+            yield line
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+async def import_keywords(chat_id: int, lines) -> int:
+    """Потоковый импорт ключевых слов пачками executemany"""
+    normalized_id = normalize_chat_id(chat_id)
+    added = 0
+    batch = []
+    first = True
+    async with chat_locks.get(normalized_id):
+        async with db_connect() as db:
+            async for line in lines:
+                keyword = parse_keyword_line(line, first)
+                first = False
+                if keyword is None:
+                    continue
+                batch.append((normalized_id, keyword))
+                if len(batch) >= IMPORT_CHUNK_SIZE:
+                    added += await insert_keywords_chunk(db, batch)
+                    batch = []
+            if batch:
+                added += await insert_keywords_chunk(db, batch)
+        # Regex пересобирается один раз после всех пачек
+        await reload_regex(normalized_id)
+    return added
+
+async def insert_keywords_chunk(db, batch: list) -> int:
+    """Вставка пачки ключевых слов одной транзакцией"""
+    changes_before = db.total_changes
+    await db.executemany(
+        'INSERT OR IGNORE INTO keywords (chat_id, keyword) VALUES (?, ?)',
+        batch
+    )
+    await db.commit()
+    return db.total_changes - changes_before
+
+async def export_keywords(chat_id: int, path: str) -> int:
+    """Потоковая выгрузка ключевых слов чата в CSV-файл"""
+    normalized_id = normalize_chat_id(chat_id)
+    count = 0
+    async with db_connect() as db:
+        cursor = await db.execute(
+            'SELECT keyword FROM keywords WHERE chat_id = ? ORDER BY keyword',
+            (normalized_id,)
+        )
+        with open(path, "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(("keyword",))
+            # Курсор отдает строки порциями, вся выборка в память не загружается
+            async for (keyword,) in cursor:
+                writer.writerow((keyword,))
+                count += 1
+    return count
 
 async def reload_regex(chat_id: int):
-    """Перезагрузка regex для чата"""
+    """Перезагрузка regex и нечеткого индекса для чата"""
     normalized_id = normalize_chat_id(chat_id)
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with db_connect() as db:
         cursor = await db.execute(
             'SELECT GROUP_CONCAT(keyword) FROM keywords WHERE chat_id = ?',
             (normalized_id,)
         )
         result = await cursor.fetchone()
         keywords_str = result[0] if result else None
-        
-        if keywords_str and normalized_id in tracked_chats:
-            try:
-                escaped_keywords = [re.escape(kw.strip().lower()) for kw in keywords_str.split(',')]
-                pattern_str = r'\b(' + '|'.join(escaped_keywords) + r')\b'
-                tracked_chats[normalized_id]["pattern"] = re.compile(pattern_str, re.IGNORECASE)
-                logger.info(f"Обновлен regex для чата {normalized_id}")
-            except Exception as e:
-                logger.error(f"Ошибка обновления regex: {e}")
-        elif normalized_id in tracked_chats:
-            tracked_chats[normalized_id]["pattern"] = None
+        cursor = await db.execute(
+            'SELECT keyword, fuzzy FROM keywords WHERE chat_id = ? AND fuzzy > 0',
+            (normalized_id,)
+        )
+        fuzzy_keywords = await cursor.fetchall()
+
+    pattern = None
+    if keywords_str:
+        try:
+            escaped_keywords = [re.escape(kw.strip().lower()) for kw in keywords_str.split(',')]
+            pattern_str = r'\b(' + '|'.join(escaped_keywords) + r')\b'
+            pattern = re.compile(pattern_str, re.IGNORECASE)
+            logger.info(f"Обновлен regex для чата {normalized_id}")
+        except Exception as e:
+            logger.error(f"Ошибка обновления regex: {e}")
+            return
+    fuzzy = FuzzyIndex(fuzzy_keywords) if fuzzy_keywords else None
+
+    # Обе структуры подменяются без await между ними: матчинг не увидит их вперемешку
+    tracked_chats.set_pattern(normalized_id, pattern)
+    tracked_chats.set_fuzzy(normalized_id, fuzzy)
+
+async def set_fuzzy_keywords(chat_id: int, keywords: list, distance: int):
+    """Добавление ключевых слов с нечетким поиском (или смена расстояния у существующих)"""
+    normalized_id = normalize_chat_id(chat_id)
+    async with chat_locks.get(normalized_id):
+        async with db_transaction() as db:
+            await db.executemany(
+                'INSERT INTO keywords (chat_id, keyword, fuzzy) VALUES (?, ?, ?) '
+                'ON CONFLICT(chat_id, keyword) DO UPDATE SET fuzzy = excluded.fuzzy',
+                [(normalized_id, kw.strip().lower(), distance) for kw in keywords]
+            )
+        await reload_regex(normalized_id)
+
+def media_text_fields(media) -> list[tuple[str, str]]:
+    """Дополнительные текстовые поля медиа: вопрос и ответы опроса, превью ссылки"""
+    fields = []
+    poll = getattr(media, "poll", None)
+    if poll is not None:
+        # С layer 178 вопрос и ответы — TextWithEntities, раньше были строками
+        question = getattr(poll.question, "text", poll.question)
+        if question:
+            fields.append(("опрос", question))
+        for answer in poll.answers or ():
+            answer_text = getattr(answer.text, "text", answer.text)
+            if answer_text:
+                fields.append(("опрос", answer_text))
+    webpage = getattr(media, "webpage", None)
+    if webpage is not None:
+        for value in (getattr(webpage, "title", None), getattr(webpage, "description", None)):
+            if value:
+                fields.append(("превью ссылки", value))
+    return fields
+
+def extract_text(message) -> tuple[str, tuple[list[int], list[str]] | None]:
+    """Весь текст сообщения для поиска и границы полей (None, если поле одно)"""
+    text = message.text or ""
+    media = message.media
+    # Быстрый путь: у обычного текстового сообщения нет дополнительных полей
+    if media is None:
+        return text, None
+    fields = media_text_fields(media)
+    if not fields:
+        return text, None
+
+    if text:
+        fields.insert(0, ("текст", text))
+    starts = []
+    names = []
+    offset = 0
+    for name, value in fields:
+        starts.append(offset)
+        names.append(name)
+        offset += len(value) + 1
+    # Одна склейка всех полей; позиции совпадений относятся к ней
+    return "\n".join(value for _, value in fields), (starts, names)
+
+def matched_fields(boundaries: tuple[list[int], list[str]], spans: list[tuple[int, int]]) -> list[str]:
+    """Названия полей, в которых найдены совпадения"""
+    starts, names = boundaries
+    fields = []
+    for start, _ in spans:
+        name = names[bisect_right(starts, start) - 1]
+        if name not in fields:
+            fields.append(name)
+    return fields
+
+# Кириллические двойники латинских букв ("iphоne" с кириллической о); сравнение идет после lower(),
+# поэтому только строчные двойники: в, н, т, к, м похожи на латиницу лишь в верхнем регистре
+HOMOGLYPHS = str.maketrans("аеорсухіјѕ", "aeopcyxijs")
+
+TOKEN_RE = re.compile(r"\w+")
+
+def fold_homoglyphs(text: str) -> str:
+    """Приведение слова к нижнему регистру и латинским двойникам"""
+    return text.lower().translate(HOMOGLYPHS)
+
+def levenshtein(a: str, b: str, limit: int) -> int:
+    """Расстояние Левенштейна с отсечкой: limit + 1, если расстояние больше limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        row_min = i
+        for j, char_b in enumerate(b, 1):
+            value = min(previous[j - 1] + (char_a != char_b), current[j - 1] + 1, previous[j] + 1)
+            current.append(value)
+            if value < row_min:
+                row_min = value
+        if row_min > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+def deletion_variants(word: str, depth: int) -> set[str]:
+    """Все варианты слова с удалением до depth символов (включая само слово)"""
+    variants = {word}
+    frontier = {word}
+    for _ in range(depth):
+        frontier = {item[:i] + item[i + 1:] for item in frontier for i in range(len(item))}
+        variants |= frontier
+    return variants
+
+class FuzzyIndex:
+    """Индекс симметричных удалений для поиска с ограниченным расстоянием Левенштейна"""
+    __slots__ = ("keywords", "variants", "max_distance", "lengths")
+
+    def __init__(self, keywords):
+        # folded -> (исходное слово, допустимое расстояние); фразы отклоняет /fuzzy_keywords
+        self.keywords: dict[str, tuple[str, int]] = {}
+        for keyword, distance in keywords:
+            if TOKEN_RE.fullmatch(keyword):
+                self.keywords[fold_homoglyphs(keyword)] = (keyword, min(distance, MAX_FUZZY_DISTANCE))
+        self.max_distance = max((distance for _, distance in self.keywords.values()), default=0)
+        # Слова на расстоянии <= k имеют общий вариант с не более чем k удалениями с каждой стороны
+        self.variants: dict[str, list[str]] = {}
+        for folded, (_, distance) in self.keywords.items():
+            for variant in deletion_variants(folded, distance):
+                self.variants.setdefault(variant, []).append(folded)
+        # Дешевый префильтр: длины токенов, которые вообще могут попасть в допуск
+        self.lengths = {
+            length
+            for folded, (_, distance) in self.keywords.items()
+            for length in range(len(folded) - distance, len(folded) + distance + 1)
+        }
+
+    def lookup(self, token: str) -> str | None:
+        """Ключевое слово в пределах своего допуска от токена (None, если нет)"""
+        if len(token) not in self.lengths:
+            return None
+        folded = fold_homoglyphs(token)
+        exact = self.keywords.get(folded)
+        if exact is not None:
+            return exact[0]
+        candidates = set()
+        for variant in deletion_variants(folded, self.max_distance):
+            candidates.update(self.variants.get(variant, ()))
+        # Кандидаты из индекса проверяются точным расстоянием с отсечкой
+        best = None
+        best_distance = self.max_distance + 1
+        for candidate in candidates:
+            allowed = self.keywords[candidate][1]
+            distance = levenshtein(folded, candidate, allowed)
+            if distance <= allowed and distance < best_distance:
+                best, best_distance = candidate, distance
+        return self.keywords[best][0] if best is not None else None
+
+def find_keywords(pattern, text: str, fuzzy: FuzzyIndex | None = None) -> tuple[set[str], list[tuple[int, int]]]:
+    """Поиск ключевых слов за один проход: найденные слова и их позиции"""
+    found = set()
+    spans = []
+    # IGNORECASE позволяет искать по исходному тексту, поэтому позиции совпадают с ним
+    for match in pattern.finditer(text):
+        found.add(match.group(1).lower())
+        spans.append(match.span())
+
+    if fuzzy is not None:
+        exact_starts = {start for start, _ in spans}
+        checked: dict[str, str | None] = {}
+        fuzzy_spans = []
+        for match in TOKEN_RE.finditer(text):
+            start = match.start()
+            if start in exact_starts:
+                continue
+            token = match.group()
+            # Каждый уникальный токен сообщения проверяется по индексу один раз
+            if token in checked:
+                keyword = checked[token]
+            else:
+                keyword = checked[token] = fuzzy.lookup(token)
+            if keyword is not None:
+                found.add(keyword)
+                fuzzy_spans.append(match.span())
+        if fuzzy_spans:
+            spans = sorted(spans + fuzzy_spans)
+    return found, spans
+
+def render_excerpt(text: str, spans: list[tuple[int, int]], limit: int = EXCERPT_LIMIT,
+                   context: int = EXCERPT_CONTEXT) -> str:
+    """Фрагмент сообщения вокруг совпадений с выделением ключевых слов (HTML)"""
+    text_len = len(text)
+    if text_len <= limit:
+        windows = [(0, text_len)]
+    else:
+        # Окна контекста вокруг совпадений; пересекающиеся окна объединяются
+        windows = []
+        budget = limit
+        for start, end in spans:
+            window_start = max(0, start - context)
+            window_end = min(text_len, end + context)
+            if windows and window_start <= windows[-1][1]:
+                prev_start, prev_end = windows[-1]
+                grow = max(0, window_end - prev_end)
+                if grow > budget:
+                    break
+                windows[-1] = (prev_start, prev_end + grow)
+                budget -= grow
+            else:
+                size = window_end - window_start
+                if windows and size > budget:
+                    break
+                windows.append((window_start, window_end))
+                budget -= size
+        if not windows:
+            windows = [(0, limit)]
+
+    parts = []
+    span_index = 0
+    span_count = len(spans)
+    for window_start, window_end in windows:
+        if window_start > 0:
+            parts.append("… ")
+        position = window_start
+        while span_index < span_count and spans[span_index][0] < window_end:
+            start, end = spans[span_index]
+            span_index += 1
+            if start < position:
+                continue
+            parts.append(html.escape(text[position:start]))
+            parts.append("<b>")
+            parts.append(html.escape(text[start:end]))
+            parts.append("</b>")
+            position = end
+        parts.append(html.escape(text[position:window_end]))
+    if windows[-1][1] < text_len:
+        parts.append(" …")
+    return "".join(parts)
 
 def escape_markdown_v2(text: str) -> str:
     """Экранирование специальных символов для MarkdownV2"""
     escape_chars = r'_*[]()~`>#+-=|{}.!'
     return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
 
-async def format_message_link(chat_id: int, message_id: int) -> str:
-    """Форматирование ссылки на сообщение"""
-    normalized_id = normalize_chat_id(chat_id)
-    chat_info = tracked_chats.get(normalized_id, {})
-    username = chat_info.get("username", "")
-    
-    if username:
-        return f"https://t.me/{username}/{message_id}"
+class NotificationTemplate:
+    """Предрендеренные части уведомления для чата"""
+    __slots__ = ("header", "link_prefix")
 
-    else:
-        # Для приватных чатов
-        return f"https://t.me/c/{abs(normalized_id)}/{message_id}" if normalized_id < 0 else f"https://t.me/c/{normalized_id}/{message_id}"
+    def __init__(self, chat: TrackedChat):
+        # Всё, что не зависит от конкретного сообщения, экранируется один раз
+        self.header = (
+            f"<b>🔔 Обнаружено ключевое слово!</b>\n\n"
+            f"<b>Чат:</b> <a href='{chat.chat_link}'>{html.escape(chat.title)}</a>\n"
+            f"<b>ID:</b> <code>{chat.chat_id}</code>\n"
+            f"<b>Автор:</b> "
+        )
+        self.link_prefix = chat.message_link_prefix
+
+    def render(self, message_id: int, author_html: str, keywords, excerpt_html: str,
+               fields: str = "") -> tuple[str, str]:
+        """Сборка текста уведомления одной склейкой, возвращает текст и ссылку"""
+        notification_html = "".join((
+            self.header,
+            author_html,
+            "\n<b>Ключевые слова:</b> ",
+            html.escape(", ".join(keywords)),
+            "\n<b>Поле:</b> " if fields else "",
+            fields,
+            "\n\n<b>Сообщение:</b>\n<blockquote>",
+            excerpt_html,
+            "</blockquote>",
+        ))
+        return notification_html, self.link_prefix + str(message_id)
+
+def message_keyboard(link: str) -> InlineKeyboardMarkup:
+    """Клавиатура с кнопкой перехода к сообщению"""
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="Перейти к сообщению", url=link)
+    ]])
+
+notification_templates: dict[ChatId, NotificationTemplate] = {}  # Кэш шаблонов по чатам
+
+def get_notification_template(chat: TrackedChat) -> NotificationTemplate:
+    """Шаблон уведомления для чата (создается при первом совпадении)"""
+    template = notification_templates.get(chat.chat_id)
+    if template is None:
+        template = notification_templates[chat.chat_id] = NotificationTemplate(chat)
+    return template
 
 def format_user_html(user) -> str:
     """Форматирование имени пользователя в HTML"""
@@ -327,7 +1258,424 @@ def format_user_html(user) -> str:
     if username:
         return f'<a href="https://t.me/{html.escape(username)}">{escaped_name}</a>'
 
-    return escaped_name
+    return escaped_name
+
+
+# ====================== Маршрутизация уведомлений ====================== #
+
+Destination = tuple[int, int]  # (chat_id получателя в Bot API, thread_id темы или 0)
+
+DEFAULT_DESTINATION: Destination = (ADMIN_ID, 0)
+
+class RouteTable:
+    """Индекс правил маршрутизации: ключевые слова/чаты -> получатели"""
+    __slots__ = ("by_chat_keyword", "by_chat", "by_keyword", "catch_all")
+
+    def __init__(self):
+        self.by_chat_keyword: dict[tuple[ChatId, str], set[Destination]] = {}
+        self.by_chat: dict[ChatId, set[Destination]] = {}
+        self.by_keyword: dict[str, set[Destination]] = {}
+        self.catch_all: set[Destination] = set()
+
+    def add(self, destination: Destination, source_chat_id: ChatId | None, keyword: str | None) -> None:
+        if source_chat_id is not None and keyword is not None:
+            self.by_chat_keyword.setdefault((source_chat_id, keyword), set()).add(destination)
+        elif source_chat_id is not None:
+            self.by_chat.setdefault(source_chat_id, set()).add(destination)
+        elif keyword is not None:
+            self.by_keyword.setdefault(keyword, set()).add(destination)
+        else:
+            self.catch_all.add(destination)
+
+    def resolve(self, chat_id: ChatId, keywords) -> dict[Destination, set[str]]:
+        """Получатели совпадения и ключевые слова для каждого; слово без маршрута уходит DEFAULT_DESTINATION"""
+        # Общие и чатовые маршруты получают все слова сообщения
+        shared = set(self.catch_all)
+        chat_destinations = self.by_chat.get(chat_id)
+        if chat_destinations:
+            shared |= chat_destinations
+        routed: dict[Destination, set[str]] = {destination: set(keywords) for destination in shared}
+        if shared and not (self.by_keyword or self.by_chat_keyword):
+            return routed
+
+        for keyword in keywords:
+            destinations = self.by_keyword.get(keyword, ())
+            pair_destinations = self.by_chat_keyword.get((chat_id, keyword), ())
+            for destination in (*destinations, *pair_destinations):
+                routed.setdefault(destination, set()).add(keyword)
+            if not (shared or destinations or pair_destinations):
+                routed.setdefault(DEFAULT_DESTINATION, set()).add(keyword)
+        return routed
+
+route_table = RouteTable()
+
+async def load_routes():
+    """Загрузка правил маршрутизации из базы в память"""
+    global route_table
+    table = RouteTable()
+    async with db_connect() as db:
+        cursor = await db.execute(
+            'SELECT d.chat_id, d.thread_id, r.source_chat_id, r.keyword '
+            'FROM routes r JOIN destinations d ON d.id = r.destination_id'
+        )
+        async for target_id, thread_id, source_chat_id, keyword in cursor:
+            table.add((target_id, thread_id), source_chat_id, keyword)
+    # Подмена целиком, чтобы обработчик сообщений не видел частично загруженную таблицу
+    route_table = table
+
+async def add_route(target_id: int, thread_id: int, source_chat_id: ChatId | None, keywords: list) -> int:
+    """Добавление правил маршрутизации, возвращает количество правил"""
+    async with db_transaction() as db:
+        await db.execute(
+            'INSERT OR IGNORE INTO destinations (chat_id, thread_id) VALUES (?, ?)',
+            (target_id, thread_id)
+        )
+        cursor = await db.execute(
+            'SELECT id FROM destinations WHERE chat_id = ? AND thread_id = ?',
+            (target_id, thread_id)
+        )
+        (destination_id,) = await cursor.fetchone()
+        data = [(destination_id, source_chat_id, kw.strip().lower()) for kw in keywords] or [
+            (destination_id, source_chat_id, None)
+        ]
+        await db.executemany(
+            'INSERT INTO routes (destination_id, source_chat_id, keyword) VALUES (?, ?, ?)',
+            data
+        )
+    await load_routes()
+    return len(data)
+
+async def remove_route(route_id: int) -> bool:
+    """Удаление правила маршрутизации"""
+    async with db_connect() as db:
+        cursor = await db.execute('DELETE FROM routes WHERE id = ?', (route_id,))
+        await db.commit()
+        removed = cursor.rowcount > 0
+    await load_routes()
+    return removed
+
+def parse_destination(ref: str) -> Destination:
+    """Разбор получателя вида <chat_id> или <chat_id>/<topic_id>"""
+    chat_part, _, thread_part = ref.partition("/")
+    return int(chat_part), int(thread_part) if thread_part else 0
+
+async def send_to_destination(destination: Destination, notifications: list, sent: list, failed: list):
+    """Отправка пачки уведомлений одному получателю по порядку; ID дописываются в sent и failed"""
+    chat_id, thread_id = destination
+    for outbox_id, notification_html, link in notifications:
+        started = time.perf_counter()
+        try:
+            await bot.send_message(
+                chat_id=chat_id,
+                message_thread_id=thread_id or None,
+                text=notification_html,
+                parse_mode=ParseMode.HTML,
+                reply_markup=message_keyboard(link),
+                disable_web_page_preview=True
+            )
+            sent.append(outbox_id)
+            health.last_send = time.monotonic()
+            if PROFILE_STAGES:
+                duration = time.perf_counter() - started
+                if duration >= SLOW_STAGE_THRESHOLD:
+                    log_slow_stages({"send": duration}, outbox_id=outbox_id, target_id=chat_id, thread_id=thread_id)
+        except TelegramRetryAfter as e:
+            # Остальное для этого получателя останется в outbox до следующего прохода
+            logger.warning(f"Флуд-лимит для {chat_id}: ожидание {e.retry_after} сек")
+            await asyncio.sleep(e.retry_after)
+            break
+        except Exception as e:
+            logger.error(f"Ошибка отправки уведомления в {chat_id}/{thread_id}: {e}", exc_info=True)
+            failed.append(outbox_id)
+
+
+# ====================== Фильтры отправителей ====================== #
+
+GLOBAL_SCOPE = 0  # chat_id глобальных правил в sender_filters
+
+class SenderFilters:
+    """Блок- и разрешающие списки отправителей: правила чата важнее глобальных.
+
+    Непустой разрешающий список области (чата или глобальный) пропускает только перечисленных
+    отправителей; блок-список отсекает перечисленных.
+    """
+    __slots__ = ("blocked", "allowed")
+
+    def __init__(self):
+        self.blocked: dict[int, set[int]] = {}
+        self.allowed: dict[int, set[int]] = {}
+
+    def add(self, chat_id: int, sender_id: int, mode: str) -> None:
+        rules = self.blocked if mode == "block" else self.allowed
+        rules.setdefault(chat_id, set()).add(sender_id)
+
+    def is_blocked(self, chat_id: ChatId, sender_id: int | None) -> bool:
+        # Без правил проверка сводится к одному условию
+        if not self.blocked and not self.allowed:
+            return False
+        allowed = self.allowed.get(chat_id)
+        if allowed:
+            return sender_id not in allowed
+        blocked = self.blocked.get(chat_id)
+        if blocked and sender_id in blocked:
+            return True
+        allowed = self.allowed.get(GLOBAL_SCOPE)
+        if allowed:
+            return sender_id not in allowed
+        blocked = self.blocked.get(GLOBAL_SCOPE)
+        return blocked is not None and sender_id in blocked
+
+sender_filters = SenderFilters()
+
+async def load_sender_filters():
+    """Загрузка фильтров отправителей из базы в память"""
+    global sender_filters
+    filters = SenderFilters()
+    async with db_connect() as db:
+        cursor = await db.execute('SELECT chat_id, sender_id, mode FROM sender_filters')
+        async for chat_id, sender_id, mode in cursor:
+            filters.add(chat_id, sender_id, mode)
+    # Подмена целиком, как и для таблицы маршрутов
+    sender_filters = filters
+
+async def set_sender_filter(sender_id: int, chat_id: int, mode: str):
+    """Блокировка или разрешение отправителя; противоположное правило той же области заменяется"""
+    async with db_connect() as db:
+        await db.execute(
+            'INSERT INTO sender_filters (chat_id, sender_id, mode) VALUES (?, ?, ?) '
+            'ON CONFLICT(chat_id, sender_id) DO UPDATE SET mode = excluded.mode',
+            (chat_id, sender_id, mode)
+        )
+        await db.commit()
+    await load_sender_filters()
+
+async def remove_sender_filter(sender_id: int, chat_id: int) -> bool:
+    """Удаление правила отправителя в области"""
+    async with db_connect() as db:
+        cursor = await db.execute(
+            'DELETE FROM sender_filters WHERE chat_id = ? AND sender_id = ?', (chat_id, sender_id)
+        )
+        await db.commit()
+        removed = cursor.rowcount > 0
+    await load_sender_filters()
+    return removed
+
+
+# ====================== Профилирование ====================== #
+
+class StageTimer:
+    """Замер стадий обработки одного сообщения"""
+    __slots__ = ("stages", "last")
+
+    def __init__(self, started: float):
+        self.stages: dict[str, float] = {}
+        self.last = started
+
+    def mark(self, stage: str):
+        now = time.monotonic()
+        self.stages[stage] = now - self.last
+        self.last = now
+
+    def report(self, **context):
+        """Структурная запись в лог, если какая-то стадия превысила порог"""
+        if any(duration >= SLOW_STAGE_THRESHOLD for duration in self.stages.values()):
+            log_slow_stages(self.stages, **context)
+
+def log_slow_stages(stages: dict[str, float], **context):
+    """Запись о медленной обработке в формате JSON"""
+    record = {
+        "event": "slow_message",
+        **context,
+        "stages_ms": {stage: round(duration * 1000, 2) for stage, duration in stages.items()},
+    }
+    logger.warning(json.dumps(record, ensure_ascii=False))
+
+class EventLoopProfiler:
+    """Запись cProfile цикла событий в файл на ограниченное время"""
+    __slots__ = ("profile", "path", "stop_handle")
+
+    def __init__(self):
+        self.profile = None
+        self.path = None
+        self.stop_handle = None
+
+    @property
+    def active(self) -> bool:
+        return self.profile is not None
+
+    def start(self, on_timeout) -> str:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        self.path = os.path.join(PROFILE_DIR, time.strftime("profile-%Y%m%d-%H%M%S.prof"))
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        # Запись останавливается сама, если про нее забыли
+        self.stop_handle = asyncio.get_running_loop().call_later(PROFILE_MAX_SECONDS, on_timeout)
+        return self.path
+
+    def stop(self) -> str:
+        self.profile.disable()
+        self.profile.dump_stats(self.path)
+        if self.stop_handle is not None:
+            self.stop_handle.cancel()
+        path = self.path
+        self.profile = self.path = self.stop_handle = None
+        return path
+
+loop_profiler = EventLoopProfiler()
+
+def stop_profiling_on_timeout():
+    """Остановка записи профиля по истечении PROFILE_MAX_SECONDS"""
+    if loop_profiler.active:
+        path = loop_profiler.stop()
+        logger.info(f"Профиль сохранен по таймауту: {path}")
+        lifecycle.spawn(bot.send_message(ADMIN_ID, f"⏱ Профиль сохранен по таймауту: {path}"))
+
+
+# ====================== Надежная доставка (outbox) ====================== #
+
+class Outbox:
+    """Долговременная очередь уведомлений в SQLite"""
+    __slots__ = ("db", "wakeup", "lock")
+
+    def __init__(self):
+        self.db = None
+        self.wakeup = asyncio.Event()
+        # Одно соединение на пакетирование и отправителя: операции не должны перемежаться
+        self.lock = asyncio.Lock()
+
+    async def open(self):
+        self.db = await aiosqlite.connect(DB_NAME)
+        await self.db.execute('PRAGMA foreign_keys = ON')
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Явная транзакция под блокировкой соединения: commit при успехе, rollback при ошибке"""
+        async with self.lock:
+            await self.db.execute('BEGIN')
+            try:
+                yield self.db
+            except BaseException:
+                await self.db.rollback()
+                raise
+            await self.db.commit()
+
+    async def put_many(self, rows: list, progress: list = ()):
+        """Запись уведомлений и прогресса по чатам в одной транзакции (дубли по ключу игнорируются)"""
+        async with self.transaction() as db:
+            if rows:
+                await db.executemany(
+                    'INSERT OR IGNORE INTO outbox '
+                    '(source_chat_id, message_id, revision, target_id, thread_id, text, link, created_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    rows
+                )
+            if progress:
+                await db.executemany(
+                    'INSERT INTO chat_state (chat_id, last_message_id) VALUES (?, ?) '
+                    'ON CONFLICT(chat_id) DO UPDATE SET '
+                    'last_message_id = MAX(last_message_id, excluded.last_message_id)',
+                    progress
+                )
+        if rows:
+            self.wakeup.set()
+
+    async def fetch_unsent(self, limit: int) -> list:
+        async with self.lock:
+            cursor = await self.db.execute(
+                'SELECT id, target_id, thread_id, text, link FROM outbox '
+                'WHERE sent_at IS NULL AND attempts < ? ORDER BY id LIMIT ?',
+                (OUTBOX_MAX_ATTEMPTS, limit)
+            )
+            return await cursor.fetchall()
+
+    async def ack(self, sent_ids: list, failed_ids: list):
+        """Пакетное подтверждение отправки и учет неудачных попыток"""
+        if not sent_ids and not failed_ids:
+            return
+        now = time.time()
+        async with self.transaction() as db:
+            if sent_ids:
+                await db.executemany(
+                    'UPDATE outbox SET sent_at = ? WHERE id = ?',
+                    [(now, outbox_id) for outbox_id in sent_ids]
+                )
+            given_up = []
+            if failed_ids:
+                await db.executemany(
+                    'UPDATE outbox SET attempts = attempts + 1 WHERE id = ?',
+                    [(outbox_id,) for outbox_id in failed_ids]
+                )
+                placeholders = ','.join(['?'] * len(failed_ids))
+                cursor = await db.execute(
+                    'SELECT id, source_chat_id, message_id, target_id, thread_id FROM outbox '
+                    f'WHERE id IN ({placeholders}) AND attempts >= ?',
+                    (*failed_ids, OUTBOX_MAX_ATTEMPTS)
+                )
+                given_up = await cursor.fetchall()
+        # Исчерпавшие попытки больше не выбираются и удаляются prune по истечении OUTBOX_RETENTION
+        for outbox_id, source_chat_id, message_id, target_id, thread_id in given_up:
+            logger.error(
+                f"Уведомление #{outbox_id} (чат {source_chat_id}, сообщение {message_id}) не доставлено "
+                f"в {target_id}/{thread_id} после {OUTBOX_MAX_ATTEMPTS} попыток"
+            )
+
+    async def pending_count(self) -> int:
+        async with self.lock:
+            cursor = await self.db.execute(
+                'SELECT COUNT(*) FROM outbox WHERE sent_at IS NULL AND attempts < ?', (OUTBOX_MAX_ATTEMPTS,)
+            )
+            (count,) = await cursor.fetchone()
+        return count
+
+    async def prune(self):
+        """Удаление давно отправленных и давно брошенных (исчерпавших попытки) записей"""
+        cutoff = time.time() - OUTBOX_RETENTION
+        async with self.transaction() as db:
+            await db.execute('DELETE FROM outbox WHERE sent_at IS NOT NULL AND sent_at < ?', (cutoff,))
+            cursor = await db.execute(
+                'DELETE FROM outbox WHERE sent_at IS NULL AND attempts >= ? AND created_at < ?',
+                (OUTBOX_MAX_ATTEMPTS, cutoff)
+            )
+        if cursor.rowcount:
+            logger.warning(f"Из outbox удалено недоставленных уведомлений: {cursor.rowcount}")
+
+outbox = Outbox()
+
+async def outbox_sender():
+    """Отправка уведомлений из outbox: группировка по получателям и пакетное подтверждение"""
+    last_prune = 0.0
+    while True:
+        outbox.wakeup.clear()
+        rows = await outbox.fetch_unsent(OUTBOX_DRAIN_LIMIT)
+        if not rows:
+            if time.monotonic() - last_prune > 3600:
+                await outbox.prune()
+                last_prune = time.monotonic()
+            await outbox.wakeup.wait()
+            continue
+
+        # Одна очередь отправки на получателя
+        outgoing: dict[Destination, list] = {}
+        for outbox_id, target_id, thread_id, notification_html, link in rows:
+            outgoing.setdefault((target_id, thread_id), []).append((outbox_id, notification_html, link))
+
+        sent_ids, failed_ids = [], []
+        try:
+            await asyncio.gather(*(
+                send_to_destination(destination, notifications, sent_ids, failed_ids)
+                for destination, notifications in outgoing.items()
+            ))
+        finally:
+            # При остановке посреди прохода подтверждаются уже отправленные
+            await outbox.ack(sent_ids, failed_ids)
+
+        if failed_ids:
+            await asyncio.sleep(OUTBOX_RETRY_DELAY)
 
 
 # ====================== Обработчики команд ====================== #
@@ -343,7 +1691,20 @@ async def cmd_start(message: types.Message):
         "/remove_chat - Удалить чат\n"
         "/add_keywords - Добавить ключевые слова\n"
         "/remove_keywords - Удалить ключевые слова\n"
-        "/list - Показать отслеживаемые чаты\n"
+        "/fuzzy_keywords - Нечеткий поиск для ключевых слов\n"
+        "/import_keywords - Импорт ключевых слов из файла\n"
+        "/export_keywords - Экспорт ключевых слов в файл\n"
+        "/list [chat_id] - Показать отслеживаемые чаты или ключевые слова чата\n"
+        "/add_route - Добавить маршрут уведомлений\n"
+        "/remove_route - Удалить маршрут\n"
+        "/routes - Показать маршруты\n"
+        "/block_sender - Игнорировать отправителя\n"
+        "/allow_sender - Учитывать только разрешенных отправителей\n"
+        "/remove_sender_filter - Удалить правило отправителя\n"
+        "/sender_filters - Показать фильтры отправителей\n"
+        "/chat_stats - Нагрузка по чатам\n"
+        "/top_keywords [период] - Самые частые ключевые слова\n"
+        "/profile start|stop - Профилирование цикла событий\n"
         "/help - Показать справку"
 
     )
@@ -402,8 +1763,9 @@ async def cmd_remove_chat(message: types.Message):
         chat_id = int(args[1])
         normalized_id = normalize_chat_id(chat_id)
 
-        if normalized_id in tracked_chats:
-            title = tracked_chats[normalized_id]["title"]
+        chat = tracked_chats.get(normalized_id)
+        if chat is not None:
+            title = chat.title
             await remove_chat(chat_id)
             await message.answer(f"❌ Чат <b>{html.escape(title)}</b> удален", 
                                parse_mode=ParseMode.HTML)
@@ -469,144 +1831,1379 @@ async def cmd_remove_keywords(message: types.Message):
 
 
 
-@dp.message(Command("list"))
-async def cmd_list(message: types.Message):
+@dp.message(Command("fuzzy_keywords"))
+async def cmd_fuzzy_keywords(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    args = message.text.split(maxsplit=3)
+    if len(args) < 4:
+        await message.answer(
+            f"Использование: /fuzzy_keywords <chat_id> <расстояние 0-{MAX_FUZZY_DISTANCE}> <ключевые слова через запятую>"
+        )
+        return
+
+    try:
+        chat_id = int(args[1])
+        distance = int(args[2])
+        keywords = [k.strip() for k in args[3].split(",") if k.strip()]
+        normalized_id = normalize_chat_id(chat_id)
+
+        if not 0 <= distance <= MAX_FUZZY_DISTANCE:
+            await message.answer(f"Расстояние должно быть от 0 до {MAX_FUZZY_DISTANCE}")
+            return
+
+        if normalized_id not in tracked_chats:
+            await message.answer("Сначала добавьте чат с помощью /add_chat")
+            return
+
+        # Нечеткий индекс работает по отдельным словам; фразы остаются только точными
+        rejected = [kw for kw in keywords if distance and not TOKEN_RE.fullmatch(kw)]
+        keywords = [kw for kw in keywords if kw not in rejected]
+        if keywords:
+            await set_fuzzy_keywords(chat_id, keywords, distance)
+        response = [
+            f"✅ Нечеткий поиск (расстояние {distance}) для {len(keywords)} ключевых слов в чате ID: <code>{normalized_id}</code>"
+        ]
+        if rejected:
+            response.append(
+                "⚠️ Нечеткий поиск доступен только для отдельных слов, пропущено: "
+                + html.escape(", ".join(rejected))
+            )
+        await message.answer("\n".join(response), parse_mode=ParseMode.HTML)
+
+    except ValueError:
+        await message.answer("Неверный формат ID чата или расстояния")
+
+@dp.message(Command("import_keywords"))
+async def cmd_import_keywords(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    # Команда приходит подписью к документу
+    args = (message.text or message.caption or "").split(maxsplit=1)
+    if len(args) < 2 or message.document is None:
+        await message.answer("Отправьте файл .txt или .csv (одно слово в строке) с подписью /import_keywords <chat_id>")
+        return
+
+    try:
+        chat_id = int(args[1])
+        normalized_id = normalize_chat_id(chat_id)
+
+        if normalized_id not in tracked_chats:
+            await message.answer("Сначала добавьте чат с помощью /add_chat")
+            return
+
+        if (message.document.file_size or 0) > IMPORT_MAX_FILE_SIZE:
+            await message.answer("Файл слишком большой (максимум 20 МБ)")
+            return
+
+        file = await bot.get_file(message.document.file_id)
+        added = await import_keywords(chat_id, iter_document_lines(file.file_path))
+        await message.answer(
+            f"✅ Импортировано {added} новых ключевых слов в чат ID: <code>{normalized_id}</code>",
+            parse_mode=ParseMode.HTML
+        )
+
+    except ValueError:
+        await message.answer("Неверный формат ID чата")
+    except Exception as e:
+        logger.error(f"Ошибка импорта ключевых слов: {e}", exc_info=True)
+        await message.answer("❌ Ошибка импорта файла")
+
+@dp.message(Command("export_keywords"))
+async def cmd_export_keywords(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer("Использование: /export_keywords <chat_id>")
+        return
+
+    try:
+        chat_id = int(args[1])
+        normalized_id = normalize_chat_id(chat_id)
+
+        if normalized_id not in tracked_chats:
+            await message.answer("Чат не найден")
+            return
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, f"keywords_{normalized_id}.csv")
+            count = await export_keywords(chat_id, path)
+            await message.answer_document(
+                FSInputFile(path),
+                caption=f"Ключевых слов: {count}"
+            )
+
+    except ValueError:
+        await message.answer("Неверный формат ID чата")
+
+@dp.message(Command("add_route"))
+async def cmd_add_route(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    args = message.text.split(maxsplit=3)
+    if len(args) < 3:
+        await message.answer(
+            "Использование: /add_route <получатель>[/<id темы>] <chat_id|*> [ключевые слова через запятую]"
+        )
+        return
+
+    try:
+        target_id, thread_id = parse_destination(args[1])
+        source_chat_id = None if args[2] == "*" else normalize_chat_id(int(args[2]))
+        keywords = [k.strip() for k in args[3].split(",") if k.strip()] if len(args) > 3 else []
+
+        if source_chat_id is not None and source_chat_id not in tracked_chats:
+            await message.answer("Сначала добавьте чат с помощью /add_chat")
+            return
+
+        count = await add_route(target_id, thread_id, source_chat_id, keywords)
+        await message.answer(
+            f"✅ Добавлено правил: {count} → <code>{target_id}</code>"
+            + (f" (тема <code>{thread_id}</code>)" if thread_id else ""),
+            parse_mode=ParseMode.HTML
+        )
+
+    except ValueError:
+        await message.answer("Неверный формат ID")
+
+@dp.message(Command("remove_route"))
+async def cmd_remove_route(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer("Укажите ID правила: /remove_route 1")
+        return
+
+    try:
+        if await remove_route(int(args[1])):
+            await message.answer("❌ Правило удалено")
+        else:
+            await message.answer("Правило не найдено")
+
+    except ValueError:
+        await message.answer("Неверный формат ID правила")
+
+@dp.message(Command("routes"))
+async def cmd_routes(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    async with db_connect() as db:
+        cursor = await db.execute(
+            'SELECT r.id, d.chat_id, d.thread_id, r.source_chat_id, r.keyword '
+            'FROM routes r JOIN destinations d ON d.id = r.destination_id '
+            'ORDER BY d.chat_id, d.thread_id, r.id'
+        )
+        rows = await cursor.fetchall()
+
+    if not rows:
+        await message.answer(f"Маршрутов нет, уведомления отправляются в <code>{ADMIN_ID}</code>",
+                             parse_mode=ParseMode.HTML)
+        return
+
+    response = ["🧭 <b>Маршруты уведомлений:</b>"]
+    for route_id, target_id, thread_id, source_chat_id, keyword in rows:
+        target = f"{target_id}/{thread_id}" if thread_id else str(target_id)
+        source = str(source_chat_id) if source_chat_id is not None else "*"
+        response.append(
+            f"#{route_id}: чат <code>{source}</code>, слово "
+            f"<code>{html.escape(keyword) if keyword is not None else '*'}</code> → <code>{target}</code>"
+        )
+
+    await message.answer('\n'.join(response), parse_mode=ParseMode.HTML)
+
+async def parse_sender_scope(message: types.Message, command: str) -> tuple[int, int] | None:
+    """Разбор аргументов <sender_id> [chat_id] (ответ с ошибкой и None, если они неверны)"""
+    args = message.text.split()
+    if len(args) < 2:
+        await message.answer(f"Использование: /{command} <sender_id> [chat_id]")
+        return None
+
+    try:
+        sender_id = int(args[1])
+        chat_id = normalize_chat_id(int(args[2])) if len(args) > 2 else GLOBAL_SCOPE
+    except ValueError:
+        await message.answer("Неверный формат ID")
+        return None
+
+    if chat_id != GLOBAL_SCOPE and chat_id not in tracked_chats:
+        await message.answer("Сначала добавьте чат с помощью /add_chat")
+        return None
+    return sender_id, chat_id
+
+async def handle_sender_filter_command(message: types.Message, mode: str):
+    """Общая часть /block_sender и /allow_sender"""
+    parsed = await parse_sender_scope(message, f"{mode}_sender")
+    if parsed is None:
+        return
+    sender_id, chat_id = parsed
+
+    await set_sender_filter(sender_id, chat_id, mode)
+    scope = f"в чате <code>{chat_id}</code>" if chat_id != GLOBAL_SCOPE else "во всех чатах"
+    if mode == "block":
+        await message.answer(f"🚫 Отправитель <code>{sender_id}</code> игнорируется {scope}", parse_mode=ParseMode.HTML)
+    else:
+        allowed = sender_filters.allowed.get(chat_id, ())
+        await message.answer(
+            f"✅ Отправитель <code>{sender_id}</code> добавлен в разрешенные {scope}. "
+            f"Теперь {scope} учитываются только разрешенные отправители ({len(allowed)})",
+            parse_mode=ParseMode.HTML
+        )
+
+@dp.message(Command("block_sender"))
+async def cmd_block_sender(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    await handle_sender_filter_command(message, "block")
+
+@dp.message(Command("allow_sender"))
+async def cmd_allow_sender(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         return
+    await handle_sender_filter_command(message, "allow")
 
-    if not tracked_chats:
-        await message.answer("Нет отслеживаемых чатов")
+@dp.message(Command("remove_sender_filter"))
+async def cmd_remove_sender_filter(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    parsed = await parse_sender_scope(message, "remove_sender_filter")
+    if parsed is None:
+        return
+    sender_id, chat_id = parsed
+
+    if await remove_sender_filter(sender_id, chat_id):
+        await message.answer("❌ Правило удалено")
+    else:
+        await message.answer("Правило не найдено")
+
+@dp.message(Command("sender_filters"))
+async def cmd_sender_filters(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    async with db_connect() as db:
+        cursor = await db.execute('SELECT chat_id, sender_id, mode FROM sender_filters ORDER BY chat_id, mode, sender_id')
+        rows = await cursor.fetchall()
+
+    if not rows:
+        await message.answer("Фильтров отправителей нет")
         return
 
-    response = ["📋 <b>Отслеживаемые чаты:</b>"]
+    response = ["👤 <b>Фильтры отправителей:</b>"]
+    for chat_id, sender_id, mode in rows:
+        scope = f"чат <code>{chat_id}</code>" if chat_id != GLOBAL_SCOPE else "все чаты"
+        action = "🚫 блок" if mode == "block" else "✅ разрешен"
+        response.append(f"<code>{sender_id}</code>: {action}, {scope}")
+
+    await message.answer('\n'.join(response), parse_mode=ParseMode.HTML)
 
-    for chat_id, chat_info in tracked_chats.items():
-        keywords = []
-        if chat_info["pattern"]:
-            # Извлекаем ключевые слова из regex
-            pattern_str = chat_info["pattern"].pattern
-            keywords = [
 
-                kw.strip('()\\b').replace(r'\\', '') for kw in pattern_str.split('|')
+async def render_chats_page(page: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Страница списка чатов с количеством ключевых слов"""
+    async with db_connect() as db:
+        cursor = await db.execute('SELECT COUNT(*) FROM chats')
+        (total,) = await cursor.fetchone()
+        pages = max(1, -(-total // LIST_PAGE_SIZE))
+        page = min(max(page, 0), pages - 1)
+        cursor = await db.execute(
+            'SELECT c.id, c.title, c.username, COUNT(k.id) '
+            'FROM chats c LEFT JOIN keywords k ON k.chat_id = c.id '
+            'GROUP BY c.id ORDER BY c.id LIMIT ? OFFSET ?',
+            (LIST_PAGE_SIZE, page * LIST_PAGE_SIZE)
+        )
+        rows = await cursor.fetchall()
 
-            ] if pattern_str else []
+    if not rows:
+        return "Нет отслеживаемых чатов", None
 
+    response = [f"📋 <b>Отслеживаемые чаты</b> ({total}):"]
+    builder = InlineKeyboardBuilder()
+    for chat_id, title, username, keyword_count in rows:
         response.append(
-            f"\n• <b>{html.escape(chat_info['title'])}</b>\n"
+            f"\n• <b>{html.escape(title)}</b>\n"
             f"ID: <code>{chat_id}</code>\n"
-            f"Username: @{chat_info.get('username', '')}\n"
-            f"Ключевые слова:\n" + "\n".join(f"- {kw}" for kw in keywords) if keywords else "- нет"
+            f"Username: @{username or 'N/A'}\n"
+            f"Ключевых слов: {keyword_count}"
+        )
+        builder.button(text=f"🔑 {title[:30]}", callback_data=f"kw:{chat_id}:0")
+    builder.adjust(1)
+    add_page_buttons(builder, "list", page, pages)
+    return "\n".join(response), builder.as_markup()
+
+async def render_keywords_page(chat_id: ChatId, page: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Страница ключевых слов чата"""
+    chat = tracked_chats.get(chat_id)
+    if chat is None:
+        return "Чат не найден", None
+
+    async with db_connect() as db:
+        cursor = await db.execute('SELECT COUNT(*) FROM keywords WHERE chat_id = ?', (chat_id,))
+        (total,) = await cursor.fetchone()
+        pages = max(1, -(-total // KEYWORDS_PAGE_SIZE))
+        page = min(max(page, 0), pages - 1)
+        # Сортировка по keyword идет по индексу (chat_id, keyword)
+        cursor = await db.execute(
+            'SELECT keyword, fuzzy FROM keywords WHERE chat_id = ? ORDER BY keyword LIMIT ? OFFSET ?',
+            (chat_id, KEYWORDS_PAGE_SIZE, page * KEYWORDS_PAGE_SIZE)
+        )
+        keywords = await cursor.fetchall()
+
+    response = [
+        f"🔑 <b>{html.escape(chat.title)}</b> (<code>{chat_id}</code>)",
+        f"Ключевых слов: {total}\n",
+    ]
+    response.extend(
+        f"- {html.escape(kw[:80])}" + (f" (~{distance})" if distance else "") for kw, distance in keywords
+    )
+    if not keywords:
+        response.append("- нет")
+
+    builder = InlineKeyboardBuilder()
+    add_page_buttons(builder, f"kw:{chat_id}", page, pages)
+    builder.row(InlineKeyboardButton(text="⬅️ К списку чатов", callback_data="list:0"))
+    return "\n".join(response), builder.as_markup()
+
+def add_page_buttons(builder: InlineKeyboardBuilder, prefix: str, page: int, pages: int):
+    """Кнопки навигации по страницам"""
+    if pages <= 1:
+        return
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀️", callback_data=f"{prefix}:{page - 1}"))
+    buttons.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=f"{prefix}:{page}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton(text="▶️", callback_data=f"{prefix}:{page + 1}"))
+    builder.row(*buttons)
+
+@dp.message(Command("chat_stats"))
+async def cmd_chat_stats(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    rows = []
+    for chat in tracked_chats:
+        stats = chat_stats.get(chat.chat_id)
+        if stats is not None:
+            seen, hits, match_time = stats.totals()
+            if seen:
+                rows.append((chat, seen, hits, match_time))
+
+    if not rows:
+        await message.answer(f"Нет сообщений за последние {STATS_WINDOW // 60} мин")
+        return
+
+    total_seen = sum(row[1] for row in rows)
+    total_match_time = sum(row[3] for row in rows) or 1e-9
+    rows.sort(key=lambda row: row[3], reverse=True)
+
+    minutes = STATS_WINDOW / 60
+    response = [f"📊 <b>Нагрузка по чатам за {STATS_WINDOW // 60} мин</b> (по времени матчинга):"]
+    for chat, seen, hits, match_time in rows[:20]:
+        seen_share = seen / total_seen
+        time_share = match_time / total_match_time
+        hot = " 🔥" if max(seen_share, time_share) >= HOT_CHAT_SHARE else ""
+        response.append(
+            f"\n• <b>{html.escape(chat.title)}</b>{hot} (<code>{chat.chat_id}</code>)\n"
+            f"Сообщений: {seen} ({seen / minutes:.1f}/мин, {seen_share:.0%})\n"
+            f"Совпадений: {hits} ({hits / seen:.1%})\n"
+            f"Матчинг: {match_time * 1000:.1f} мс, {match_time / seen * 1e6:.0f} мкс/сообщ. ({time_share:.0%})"
+        )
+
+    await message.answer('\n'.join(response), parse_mode=ParseMode.HTML)
+
+def parse_period(value: str) -> int:
+    """Период вида 12h / 7d в часах"""
+    value = value.strip().lower()
+    if value.endswith("d"):
+        return int(value[:-1]) * 24
+    if value.endswith("h"):
+        return int(value[:-1])
+    return int(value)
+
+@dp.message(Command("top_keywords"))
+async def cmd_top_keywords(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    args = message.text.split(maxsplit=1)
+    try:
+        hours = parse_period(args[1]) if len(args) > 1 else 24
+        if hours <= 0:
+            raise ValueError
+    except ValueError:
+        await message.answer("Использование: /top_keywords [период, например 24h или 7d]")
+        return
+
+    # Несохраненные счетчики сбрасываются, чтобы ответ был актуальным
+    await keyword_counters.flush()
+    since_bucket = int(time.time()) // 3600 - hours + 1
+    async with db_connect() as db:
+        cursor = await db.execute(
+            'SELECT keyword, SUM(hits), COUNT(DISTINCT chat_id) FROM keyword_hits '
+            'WHERE bucket >= ? GROUP BY keyword ORDER BY SUM(hits) DESC LIMIT 20',
+            (since_bucket,)
         )
+        rows = await cursor.fetchall()
+
+    if not rows:
+        await message.answer("Срабатываний за период нет")
+        return
+
+    response = [f"🏆 <b>Топ ключевых слов за {hours} ч:</b>"]
+    for keyword, hits, chats in rows:
+        response.append(f"• {html.escape(keyword)} — {hits} (чатов: {chats})")
 
     await message.answer('\n'.join(response), parse_mode=ParseMode.HTML)
 
+@dp.message(Command("profile"))
+async def cmd_profile(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    args = message.text.split(maxsplit=1)
+    action = args[1].strip().lower() if len(args) > 1 else ""
+
+    if action == "start":
+        if loop_profiler.active:
+            await message.answer("Профилирование уже запущено")
+            return
+        loop_profiler.start(stop_profiling_on_timeout)
+        await message.answer(f"⏱ Профилирование запущено (не дольше {PROFILE_MAX_SECONDS} сек)")
+    elif action == "stop":
+        if not loop_profiler.active:
+            await message.answer("Профилирование не запущено")
+            return
+        path = loop_profiler.stop()
+        await message.answer_document(FSInputFile(path), caption=f"Профиль: {path}")
+    else:
+        await message.answer("Использование: /profile start|stop")
+
+@dp.message(Command("list"))
+async def cmd_list(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    args = message.text.split(maxsplit=1)
+
+    try:
+        if len(args) > 1:
+            text, markup = await render_keywords_page(normalize_chat_id(int(args[1])), 0)
+        else:
+            text, markup = await render_chats_page(0)
+    except ValueError:
+        await message.answer("Неверный формат ID чата")
+        return
+
+    await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+@dp.callback_query(F.data.startswith("list:") | F.data.startswith("kw:"))
+async def on_list_page(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        return
+
+    parts = callback.data.split(":")
+    if parts[0] == "list":
+        text, markup = await render_chats_page(int(parts[1]))
+    else:
+        text, markup = await render_keywords_page(ChatId(int(parts[1])), int(parts[2]))
+
+    try:
+        await callback.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    except TelegramBadRequest:
+        # Страница не изменилась (повторное нажатие)
+        pass
+    await callback.answer()
+
 # ====================== Обработчик сообщений ====================== #
 
+class MessageBatcher:
+    """Адаптивное пакетирование: размер пакета по темпу поступления и срок ожидания"""
+    __slots__ = ("queue", "ready", "idle", "target_size", "rate", "arrivals", "window_started",
+                 "last_arrival", "failures", "latencies", "processed", "stats_started")
+
+    def __init__(self):
+        self.queue: deque[tuple[ChatId, object, float]] = deque()
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()  # Очередь пуста и пакет не обрабатывается
+        self.target_size = 1
+        self.rate = 0.0  # Сглаженный темп поступления, сообщений/сек
+        self.arrivals = 0
+        self.window_started = time.monotonic()
+        self.last_arrival = 0.0
+        self.failures = 0  # Неудачных записей пакета подряд
+        self.latencies: deque[float] = deque(maxlen=2000)
+        self.processed = 0
+        self.stats_started = time.monotonic()
+
+    def put(self, normalized_chat_id: ChatId, message):
+        """Постановка сообщения в очередь (живые апдейты и догон используют один путь)"""
+        now = time.monotonic()
+        self.queue.append((normalized_chat_id, message, now))
+        self.idle.clear()
+        self.arrivals += 1
+        gap = now - self.last_arrival
+        self.last_arrival = now
+        elapsed = now - self.window_started
+        if gap > BATCH_MAX_WAIT:
+            # Затишье: темп затухает по длине паузы, а первое сообщение после нее не ждет набора пакета
+            self.rate *= math.exp(-gap / BATCH_RATE_TIME_CONSTANT)
+            self.arrivals = 1
+            self.window_started = now
+            self.target_size = 1
+        elif elapsed >= BATCH_MAX_WAIT:
+            # Сглаживание с учетом длины окна: чем длиннее окно, тем меньше вес прежнего темпа
+            alpha = 1 - math.exp(-elapsed / BATCH_RATE_TIME_CONSTANT)
+            self.rate += alpha * (self.arrivals / elapsed - self.rate)
+            self.arrivals = 0
+            self.window_started = now
+            # Сколько сообщений в среднем приходит за срок ожидания — столько и собираем
+            self.target_size = max(1, min(BATCH_MAX_SIZE, round(self.rate * BATCH_MAX_WAIT)))
+        # Будим цикл только на первом сообщении и при наборе целевого размера
+        size = len(self.queue)
+        if size == 1 or size >= self.target_size:
+            self.ready.set()
+
+    def idle_gap(self) -> float:
+        """Пауза без поступлений, после которой набора target_size уже не дождаться"""
+        if self.rate <= 0:
+            return BATCH_MIN_IDLE_GAP
+        return min(BATCH_MAX_WAIT, max(BATCH_MIN_IDLE_GAP, BATCH_IDLE_GAPS / self.rate))
+
+    async def run(self):
+        """Сбор пакетов по событию: до target_size сообщений, но не дольше BATCH_MAX_WAIT
+        и без ожидания после того, как поток прервался (хвост всплеска уходит сразу)"""
+        while True:
+            self.ready.clear()
+            if not self.queue:
+                self.idle.set()
+                await self.ready.wait()
+                continue
+            now = time.monotonic()
+            timeout = min(
+                self.queue[0][2] + BATCH_MAX_WAIT - now,
+                self.last_arrival + self.idle_gap() - now
+            )
+            if len(self.queue) < self.target_size and timeout > 0:
+                try:
+                    await asyncio.wait_for(self.ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.flush()
+
+    async def flush(self):
+        """Обработка одного пакета"""
+        count = min(len(self.queue), BATCH_MAX_SIZE)
+        batch = [self.queue.popleft() for _ in range(count)]
+        try:
+            await process_message_batch(batch)
+        except Exception as e:
+            # Пакет не записан: он возвращается в начало очереди, иначе следующий пакет
+            # сдвинет прогресс чатов за эти сообщения и догрузка их уже не вернет
+            self.failures += 1
+            delay = min(BATCH_RETRY_MAX_DELAY, BATCH_RETRY_DELAY * 2 ** (self.failures - 1))
+            logger.error(f"Ошибка обработки пакета, повтор через {delay:.0f} с: {e}", exc_info=True)
+            self.queue.extendleft(reversed(batch))
+            await asyncio.sleep(delay)
+            return
+        self.failures = 0
+
+        done = time.monotonic()
+        self.latencies.extend(done - enqueued for _, _, enqueued in batch)
+        self.processed += count
+        if done - self.stats_started >= BATCH_STATS_INTERVAL:
+            self.log_stats(done)
+
+    def log_stats(self, now: float):
+        """Пропускная способность и p99 задержки обнаружения за период"""
+        latencies = sorted(self.latencies)
+        p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0.0
+        throughput = self.processed / (now - self.stats_started)
+        logger.info(
+            f"Пакетирование: {throughput:.1f} сообщ./сек, пакет {self.target_size}, "
+            f"очередь {len(self.queue)}, p99 задержки {p99 * 1000:.0f} мс"
+        )
+        self.latencies.clear()
+        self.processed = 0
+        self.stats_started = now
+
+batcher = MessageBatcher()
+
+class AlbumMessage:
+    """Альбом как одно сообщение: подписи частей склеены, ссылка и автор — по первой части"""
+    __slots__ = ("id", "last_id", "part_ids", "text", "media", "edit_date", "grouped_id", "first")
+
+    def __init__(self, parts: list):
+        parts.sort(key=lambda part: part.id)
+        first = parts[0]
+        self.id = first.id
+        # Прогресс чата — по последней части, иначе догрузка повторит остальные
+        self.last_id = parts[-1].id
+        # Правка приходит по отдельной части — кэш совпадений хранит альбом под каждой из них
+        self.part_ids = tuple(part.id for part in parts)
+        self.text = "\n".join(part.text for part in parts if part.text)
+        self.media = None
+        self.edit_date = None
+        self.grouped_id = first.grouped_id
+        self.first = first
+
+    async def get_sender(self):
+        return await self.first.get_sender()
+
+class AlbumBuffer:
+    """Сбор частей альбома (общий grouped_id) перед передачей в пакетирование"""
+    __slots__ = ("groups",)
+
+    def __init__(self):
+        self.groups: dict[tuple[ChatId, int], tuple[list, asyncio.TimerHandle]] = {}
+
+    def put(self, normalized_chat_id: ChatId, message):
+        key = (normalized_chat_id, message.grouped_id)
+        group = self.groups.get(key)
+        if group is None:
+            handle = asyncio.get_running_loop().call_later(ALBUM_WAIT, self.flush, key)
+            group = self.groups[key] = ([], handle)
+        parts = group[0]
+        parts.append(message)
+        # Больше частей в альбоме не бывает — дальше ждать незачем
+        if len(parts) >= ALBUM_MAX_PARTS:
+            group[1].cancel()
+            self.flush(key)
+
+    def flush(self, key: tuple[ChatId, int]):
+        parts, _ = self.groups.pop(key)
+        batcher.put(key[0], AlbumMessage(parts) if len(parts) > 1 else parts[0])
+
+    def open_floor(self, normalized_chat_id: ChatId) -> int | None:
+        """Наименьший ID части среди незавершенных альбомов чата (None, если их нет)"""
+        floor = None
+        for (chat_id, _), (parts, _) in self.groups.items():
+            if chat_id == normalized_chat_id:
+                first_id = min(part.id for part in parts)
+                if floor is None or first_id < floor:
+                    floor = first_id
+        return floor
+
+    def flush_all(self):
+        """Передача всех незавершенных альбомов без ожидания"""
+        for key in list(self.groups):
+            self.groups[key][1].cancel()
+            self.flush(key)
+
+album_buffer = AlbumBuffer()
+
+class MessageRetries:
+    """Повторная обработка сообщений, уведомление о которых подготовить не удалось.
+
+    Пока повтор не завершен, прогресс чата не продвигается дальше такого сообщения:
+    после перезапуска догрузка вернет его снова.
+    """
+    __slots__ = ("attempts",)
+
+    def __init__(self):
+        self.attempts: dict[ChatId, dict[int, int]] = {}
+
+    def floor(self, normalized_chat_id: ChatId) -> int | None:
+        """Наименьший ID сообщения чата, ожидающего повтора (None, если таких нет)"""
+        pending = self.attempts.get(normalized_chat_id)
+        return min(pending) if pending else None
+
+    def release(self, normalized_chat_id: ChatId, message_id: int):
+        pending = self.attempts.get(normalized_chat_id)
+        if pending and pending.pop(message_id, None) is not None and not pending:
+            del self.attempts[normalized_chat_id]
+
+    def schedule(self, normalized_chat_id: ChatId, message):
+        pending = self.attempts.setdefault(normalized_chat_id, {})
+        attempt = pending.get(message.id, 0) + 1
+        if attempt > MESSAGE_RETRY_LIMIT:
+            self.release(normalized_chat_id, message.id)
+            logger.error(
+                f"Сообщение {message.id} в чате {normalized_chat_id} не обработано "
+                f"после {MESSAGE_RETRY_LIMIT} повторов"
+            )
+            return
+        pending[message.id] = attempt
+        delay = MESSAGE_RETRY_DELAY * 2 ** (attempt - 1)
+        asyncio.get_running_loop().call_later(delay, batcher.put, normalized_chat_id, message)
+
+message_retries = MessageRetries()
+
+def enqueue_message(normalized_chat_id: ChatId, message):
+    """Новое сообщение в конвейер: части альбома сначала собираются вместе"""
+    get_chat_stats(normalized_chat_id).record_arrival()
+    if message.grouped_id is not None:
+        album_buffer.put(normalized_chat_id, message)
+    else:
+        batcher.put(normalized_chat_id, message)
+
+
 @userbot.on(events.NewMessage)
 async def handle_new_message(event):
     """Буферизация сообщений для пакетной обработки"""
+    health.last_update = time.monotonic()
     # Нормализуем ID чата перед обработкой
+    if PROFILE_STAGES:
+        started = time.perf_counter()
+        normalized_chat_id = normalize_chat_id(event.chat_id)
+        duration = time.perf_counter() - started
+        if duration >= SLOW_STAGE_THRESHOLD:
+            log_slow_stages({"normalize": duration}, chat_id=event.chat_id, message_id=event.message.id)
+    else:
+        normalized_chat_id = normalize_chat_id(event.chat_id)
+    # Проверяем, отслеживается ли этот чат; заблокированные отправители отсекаются до разбора текста.
+    # Личный чат с пользователем X не должен совпасть с отслеживаемым каналом X
+    if event.chat_id < 0 and normalized_chat_id in tracked_chats:
+        if recorder is not None:
+            recorder.write(event)
+        if not sender_filters.is_blocked(normalized_chat_id, event.sender_id):
+            enqueue_message(normalized_chat_id, event.message)
+    elif RECORD_ALL_CHATS and recorder is not None:
+        # Полный поток, включая личные сообщения аккаунта, — только по явному разрешению
+        recorder.write(event)
+
+@userbot.on(events.MessageEdited)
+async def handle_edited_message(event):
+    """Повторная проверка отредактированных сообщений"""
+    health.last_update = time.monotonic()
     normalized_chat_id = normalize_chat_id(event.chat_id)
-    # Проверяем, отслеживается ли этот чат
-    if normalized_chat_id in tracked_chats:
-        pending_messages.append((normalized_chat_id, event))
-
-    # Обрабатываем пакет при достижении размера
-    if len(pending_messages) >= BATCH_SIZE:
-        await process_message_batch()
+    # Личные чаты отсекаются, как и в handle_new_message
+    if (event.chat_id < 0 and normalized_chat_id in tracked_chats
+            and not sender_filters.is_blocked(normalized_chat_id, event.sender_id)):
+        get_chat_stats(normalized_chat_id).record_arrival()
+        batcher.put(normalized_chat_id, event.message)
 
-async def process_message_batch():
+async def process_message_batch(batch: list):
     """Пакетная обработка сообщений"""
-    global pending_messages
-    if not pending_messages:
+    # Параллельная обработка: ошибка одного сообщения не прерывает остальные
+    hit_updates: list = []
+    results = await asyncio.gather(
+        *(process_message(chat_id, message, hit_updates, enqueued) for chat_id, message, enqueued in batch),
+        return_exceptions=True
+    )
+
+    rows = []
+    progress: dict[ChatId, int] = {}
+    failed = []
+    failed_floors: dict[ChatId, int] = {}
+    for (normalized_chat_id, message, _), result in zip(batch, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Ошибка подготовки уведомления: {result}", exc_info=result)
+            failed.append((normalized_chat_id, message))
+            if message.id < failed_floors.get(normalized_chat_id, message.id + 1):
+                failed_floors[normalized_chat_id] = message.id
+            continue
+        message_retries.release(normalized_chat_id, message.id)
+        if result:
+            rows.extend(result)
+        last_id = getattr(message, "last_id", message.id)
+        if last_id > progress.get(normalized_chat_id, 0):
+            progress[normalized_chat_id] = last_id
+
+    # Прогресс не обгоняет сообщения, которые еще ждут повтора или собираются в альбом:
+    # после перезапуска догрузка вернет их снова
+    for normalized_chat_id in progress:
+        floors = [
+            floor for floor in (
+                failed_floors.get(normalized_chat_id),
+                message_retries.floor(normalized_chat_id),
+                album_buffer.open_floor(normalized_chat_id),
+            ) if floor is not None
+        ]
+        if floors and progress[normalized_chat_id] >= min(floors):
+            progress[normalized_chat_id] = min(floors) - 1
+
+    # Уведомления и прогресс по чатам пакета записываются одной транзакцией
+    progress_rows = [
+        (chat_id, message_id) for chat_id, message_id in progress.items()
+        if message_id > last_seen_ids.get(chat_id, 0)
+    ]
+    if rows or progress_rows:
+        await outbox.put_many(rows, progress_rows)
+    last_seen_ids.update(progress_rows)
+    # Кэш обновляется только после записи в outbox: при ошибке версия будет проверена заново
+    for normalized_chat_id, message_ids, text_hash, keywords in hit_updates:
+        for message_id in message_ids:
+            hit_cache.put(normalized_chat_id, message_id, text_hash, keywords)
+    for normalized_chat_id, message in failed:
+        message_retries.schedule(normalized_chat_id, message)
+
+
+async def process_message(normalized_chat_id: ChatId, message, hit_updates: list, enqueued: float | None = None):
+    """Обработка отдельного сообщения: строки outbox для всех получателей, обновление кэша — в hit_updates.
+
+    Ошибки не перехватываются: пакет откладывает такое сообщение на повтор.
+    """
+    timer = None
+    if PROFILE_STAGES and enqueued is not None:
+        # Первая стадия — ожидание в очереди пакетирования
+        timer = StageTimer(enqueued)
+        timer.mark("queue")
+
+    chat = tracked_chats.get(normalized_chat_id)
+
+    if chat is None or not chat.pattern:
+        return
+
+    # Текст, подпись, опрос и превью ссылки склеиваются в одну строку
+    text, boundaries = extract_text(message)
+    if not text:
         return
-    # Создаем задачи для обработки
-    tasks = []
-    for normalized_chat_id, event in pending_messages[:BATCH_SIZE]:
-        tasks.append(process_message(normalized_chat_id, event))
 
-    # Параллельная обработка
-    await asyncio.gather(*tasks)
-    # Удаляем обработанные сообщения
-    pending_messages = pending_messages[BATCH_SIZE:]
+    # Правка без изменения текста (или повтор уже обработанного сообщения) не сканируется
+    text_hash = hash(text)
+    cached = hit_cache.get(normalized_chat_id, message.id)
+    if cached is not None and cached[0] == text_hash:
+        return
 
+    # Поиск ключевых слов через regex: слова и позиции за один проход
+    match_started = time.perf_counter()
+    found_keywords, spans = find_keywords(chat.pattern, text, chat.fuzzy)
+    match_seconds = time.perf_counter() - match_started
+    hit_update = (normalized_chat_id, getattr(message, "part_ids", (message.id,)), text_hash, frozenset(found_keywords))
 
-async def process_message(normalized_chat_id: int, event):
-    """Обработка отдельного сообщения"""
-    chat_info = tracked_chats.get(normalized_chat_id)
+    # Уведомляем только о словах, которых не было в прошлой версии сообщения
+    if cached is not None:
+        found_keywords -= cached[1]
 
-    if not chat_info or not chat_info["pattern"] or not event.message.text:
-        return
-    
-    # Поиск ключевых слов через regex
-    text = event.message.text.lower()
-    matches = chat_info["pattern"].findall(text)
+    get_chat_stats(normalized_chat_id).record_match(bool(found_keywords), match_seconds)
+
+    if timer is not None:
+        timer.mark("match")
 
-    if not matches:
+    if not found_keywords:
+        hit_updates.append(hit_update)
+        if timer is not None:
+            timer.report(chat_id=normalized_chat_id, message_id=message.id)
         return
 
-    found_keywords = set(matches)
     logger.info(f"Найдены ключевые слова в чате {normalized_chat_id}: {found_keywords}")
 
-    try:
-        # Формирование ссылок
-        message_link = await format_message_link(normalized_chat_id, event.message.id)
-        chat_link = f"https://t.me/{chat_info['username']}" if chat_info.get("username") else ""
+    # Формирование информации об авторе
+    sender = await message.get_sender()
+    author_html = format_user_html(sender)
+    if timer is not None:
+        timer.mark("sender")
+
+    # Формирование уведомления по шаблону чата: каждый получатель видит только свои слова
+    template = get_notification_template(chat)
+    excerpt_html = render_excerpt(text, spans)
+    fields = ", ".join(matched_fields(boundaries, spans)) if boundaries else ""
+    rendered: dict[frozenset, tuple[str, str]] = {}
+    now = time.time()
+    # У правок даты с точностью до секунды: ревизия — по набору новых слов, а не по edit_date
+    revision = (zlib.crc32("\n".join(sorted(found_keywords)).encode()) or 1) if message.edit_date else 0
+    rows = []
+    for (target_id, thread_id), keywords in route_table.resolve(normalized_chat_id, found_keywords).items():
+        key = frozenset(keywords)
+        if key not in rendered:
+            rendered[key] = template.render(message.id, author_html, sorted(keywords), excerpt_html, fields)
+        notification_html, link = rendered[key]
+        # Строки outbox: по одной на каждого получателя; правки получают свою ревизию
+        rows.append((normalized_chat_id, message.id, revision, target_id, thread_id, notification_html, link, now))
+    if timer is not None:
+        timer.mark("render")
+        timer.report(chat_id=normalized_chat_id, message_id=message.id, keywords=sorted(found_keywords))
+    # Счетчики — только после успешной подготовки, иначе повтор учтет совпадение дважды
+    keyword_counters.add(normalized_chat_id, found_keywords)
+    hit_updates.append(hit_update)
+    return rows
+
+
+# ====================== Догон пропущенных сообщений ====================== #
+
+async def load_chat_state():
+    """Загрузка последних обработанных message_id по чатам"""
+    async with db_connect() as db:
+        cursor = await db.execute('SELECT chat_id, last_message_id FROM chat_state')
+        async for chat_id, last_message_id in cursor:
+            last_seen_ids[ChatId(chat_id)] = last_message_id
+
+async def catch_up_chat(chat_id: ChatId, min_id: int, semaphore: asyncio.Semaphore) -> int:
+    """Прогон пропущенных сообщений одного чата через обычный конвейер"""
+    async with semaphore:
+        peer = PeerChannel(chat_id) if chat_id > 0 else PeerChat(-chat_id)
+        count = 0
+        last_id = min_id
+        try:
+            async for message in userbot.iter_messages(peer, min_id=min_id, limit=CATCHUP_LIMIT, reverse=True):
+                if not sender_filters.is_blocked(chat_id, message.sender_id):
+                    enqueue_message(chat_id, message)
+                count += 1
+                last_id = message.id
+        except Exception as e:
+            logger.error(f"Ошибка догона сообщений в чате {chat_id}: {e}")
+        if count >= CATCHUP_LIMIT:
+            # reverse=True берет самые старые пропущенные; более новые остаются непросмотренными
+            logger.warning(
+                f"Догон чата {chat_id} достиг лимита {CATCHUP_LIMIT} сообщений, "
+                f"сообщения новее {last_id} пропущены"
+            )
+        return count
+
+async def catch_up_missed():
+    """Догон сообщений, пропущенных за время простоя или разрыва соединения"""
+    semaphore = asyncio.Semaphore(CATCHUP_CONCURRENCY)
+    # Чаты без сохраненного прогресса только что добавлены — догонять нечего
+    chats = [(chat.chat_id, last_seen_ids[chat.chat_id]) for chat in tracked_chats if chat.chat_id in last_seen_ids]
+    counts = await asyncio.gather(*(catch_up_chat(chat_id, min_id, semaphore) for chat_id, min_id in chats))
+    logger.info(f"Догон завершен: {sum(counts)} сообщений в {len(chats)} чатах")
+
+async def connection_watchdog():
+    """Переподключение userbot и догон сообщений после потери соединения"""
+    while True:
+        await asyncio.sleep(CONNECTION_CHECK_INTERVAL)
+        if userbot.is_connected():
+            continue
+        logger.warning("Userbot отключен, переподключение")
+        try:
+            await userbot.connect()
+        except Exception as e:
+            logger.error(f"Не удалось переподключиться: {e}")
+            continue
+        lifecycle.spawn(catch_up_missed())
+
+
+# ====================== Обслуживание базы ====================== #
+
+async def cleanup_db():
+    """Удаление осиротевших строк и инкрементальное освобождение места"""
+    async with db_transaction() as db:
+        cursor = await db.execute('DELETE FROM keywords WHERE chat_id NOT IN (SELECT id FROM chats)')
+        keywords_removed = cursor.rowcount
+        cursor = await db.execute(
+            'DELETE FROM routes WHERE destination_id NOT IN (SELECT id FROM destinations) '
+            'OR (source_chat_id IS NOT NULL AND source_chat_id NOT IN (SELECT id FROM chats))'
+        )
+        routes_removed = cursor.rowcount
+        await db.execute('DELETE FROM chat_state WHERE chat_id NOT IN (SELECT id FROM chats)')
+        await db.execute(
+            'DELETE FROM sender_filters WHERE chat_id != ? AND chat_id NOT IN (SELECT id FROM chats)',
+            (GLOBAL_SCOPE,)
+        )
+        # Первичный ключ keyword_hits начинается с bucket — удаление старых часов идет по индексу
+        cursor = await db.execute(
+            'DELETE FROM keyword_hits WHERE bucket < ?',
+            (int(time.time()) // 3600 - KEYWORD_HITS_RETENTION,)
+        )
+        hits_removed = cursor.rowcount
+    async with db_connect() as db:
+        # executescript прогоняет прагму до конца; execute освободил бы только одну страницу
+        await db.executescript(f'PRAGMA incremental_vacuum({CLEANUP_VACUUM_PAGES});')
+    if keywords_removed or routes_removed or hits_removed:
+        logger.info(
+            f"Очистка базы: удалено ключевых слов {keywords_removed}, маршрутов {routes_removed}, "
+            f"строк статистики {hits_removed}"
+        )
+        if routes_removed:
+            await load_routes()
+
+async def cleanup_loop():
+    """Периодическое обслуживание базы"""
+    while True:
+        try:
+            await cleanup_db()
+        except Exception as e:
+            logger.error(f"Ошибка очистки базы: {e}")
+        await asyncio.sleep(CLEANUP_INTERVAL)
+
+
+# ====================== Запись и воспроизведение апдейтов ====================== #
+
+class UpdateRecorder:
+    """Запись входящих сообщений в сжатый JSONL только на дозапись"""
+    __slots__ = ("file", "pending")
+
+    def __init__(self, path: str):
+        # Каждый запуск дописывает новый gzip-член; склеенные члены читаются как один поток
+        self.file = gzip.open(path, "ab")
+        self.pending: list[bytes] = []
+
+    def write(self, event):
+        message = event.message
+        sender = message.sender
+        record = {
+            "chat_id": event.chat_id,
+            "message_id": message.id,
+            "received": time.time(),
+            "date": message.date.timestamp() if message.date else None,
+            "text": message.text or "",
+            "sender_id": message.sender_id,
+            "sender_name": getattr(sender, "first_name", None) or getattr(sender, "title", None),
+            "sender_username": getattr(sender, "username", None),
+        }
+        if message.grouped_id is not None:
+            record["grouped_id"] = message.grouped_id
+        if message.media is not None:
+            fields = media_text_fields(message.media)
+            if fields:
+                record["fields"] = fields
+        self.pending.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode())
+        if len(self.pending) >= RECORD_FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        """Сжатие накопленных записей одним вызовом и синхронизирующий сброс на диск"""
+        if self.pending:
+            self.pending.append(b"")
+            self.file.write(b"\n".join(self.pending))
+            self.pending.clear()
+            # При аварии теряются только записи после последнего сброса
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+recorder: UpdateRecorder | None = None
+
+class ReplaySender:
+    """Автор записанного сообщения"""
+    __slots__ = ("id", "first_name", "username")
+
+    def __init__(self, sender_id, first_name, username):
+        self.id = sender_id
+        self.first_name = first_name
+        self.username = username
+
+class ReplayMessage:
+    """Записанное сообщение с интерфейсом, который использует конвейер обработки"""
+    __slots__ = ("id", "text", "date", "edit_date", "grouped_id", "media", "sender")
+
+    def __init__(self, record: dict):
+        self.id = record["message_id"]
+        self.text = record["text"]
+        self.date = record["date"]
+        self.edit_date = None
+        self.grouped_id = record.get("grouped_id")
+        self.media = replay_media(record["fields"]) if "fields" in record else None
+        self.sender = ReplaySender(record["sender_id"], record["sender_name"], record["sender_username"])
+
+    async def get_sender(self):
+        return self.sender
+
+class ReplayEvent:
+    __slots__ = ("chat_id", "sender_id", "message")
+
+    def __init__(self, record: dict):
+        self.chat_id = record["chat_id"]
+        self.sender_id = record["sender_id"]
+        self.message = ReplayMessage(record)
+
+def replay_media(fields: list) -> SimpleNamespace:
+    """Восстановление опроса и превью ссылки из записанных полей для media_text_fields"""
+    poll_texts = [value for name, value in fields if name == "опрос"]
+    webpage_texts = [value for name, value in fields if name == "превью ссылки"]
+    poll = webpage = None
+    if poll_texts:
+        poll = SimpleNamespace(
+            question=poll_texts[0],
+            answers=[SimpleNamespace(text=text) for text in poll_texts[1:]]
+        )
+    if webpage_texts:
+        webpage = SimpleNamespace(
+            title=webpage_texts[0],
+            description=webpage_texts[1] if len(webpage_texts) > 1 else None
+        )
+    return SimpleNamespace(poll=poll, webpage=webpage)
+
+def iter_recording(path: str):
+    """Чтение записи; оборванный при аварии хвост пропускается"""
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        try:
+            for line in file:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile):
+            logger.warning(f"Запись {path} оборвана, воспроизведены только целые строки")
+
+class ReplayBot:
+    """Заглушка Bot API: уведомления только подсчитываются"""
+    __slots__ = ("sent",)
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, **kwargs):
+        self.sent += 1
+
+async def replay(path: str, speed: float):
+    """Прогон записи через handle_new_message с темпом оригинала, ускоренным в speed раз (0 — без пауз)"""
+    global DB_NAME, bot
+
+    # Копия базы: воспроизведение не трогает рабочие outbox и прогресс догона
+    replay_db = os.path.join(tempfile.mkdtemp(prefix="replay-"), os.path.basename(DB_NAME))
+    if os.path.exists(DB_NAME):
+        shutil.copyfile(DB_NAME, replay_db)
+    DB_NAME = replay_db
+    bot = ReplayBot()
+
+    await init_db()
+    async with db_connect() as db:
+        await db.execute('DELETE FROM outbox')
+        await db.commit()
+    await load_tracked_data()
+    await load_routes()
+    await load_sender_filters()
+    await outbox.open()
+    tasks = [lifecycle.spawn(batcher.run()), lifecycle.spawn(outbox_sender())]
+
+    count = 0
+    started = time.monotonic()
+    first_received = None
+    for record in iter_recording(path):
+        if speed > 0:
+            if first_received is None:
+                first_received = record["received"]
+            delay = started + (record["received"] - first_received) / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            # Без пауз, но с передачей управления конвейеру
+            await asyncio.sleep(0)
+        await handle_new_message(ReplayEvent(record))
+        count += 1
+
+    # Дожидаемся обработки очереди и отправки всех уведомлений
+    await drain_pipeline()
+    elapsed = time.monotonic() - started
+
+    await lifecycle.cancel(tasks)
+    await outbox.close()
+    batcher.log_stats(time.monotonic())
+    logger.info(
+        f"Воспроизведение: {count} сообщений за {elapsed:.2f} сек "
+        f"({count / elapsed if elapsed else 0:.1f} сообщ./сек), уведомлений {bot.sent}"
+    )
+    shutil.rmtree(os.path.dirname(replay_db), ignore_errors=True)
 
-        # Формирование информации об авторе
-        sender = await event.get_sender()
-        author_html = format_user_html(sender)
 
-        # Создание клавиатуры
-        builder = InlineKeyboardBuilder()
-        builder.button(text="Перейти к сообщению", url=message_link)
+# ====================== Мониторинг состояния ====================== #
 
-        # Формирование уведомления
-        notification_html = (
-            f"<b>🔔 Обнаружено ключевое слово!</b>\n\n"
-            f"<b>Чат:</b> <a href='{chat_link}'>{html.escape(chat_info['title'])}</a>\n"
-            f"<b>ID:</b> <code>{normalized_chat_id}</code>\n"
-            f"<b>Автор:</b> {author_html}\n"
-            f"<b>Ключевые слова:</b> {', '.join(found_keywords)}\n\n"
-            f"<b>Сообщение:</b>\n<code>{html.escape(event.message.text[:800])}</code>"
-        )
+class HealthMonitor:
+    """Задержка цикла событий, свежесть апдейтов и отправок, HTTP-проверки /health и /ready"""
+    __slots__ = ("lags", "last_update", "last_send", "started", "runner")
 
-        await bot.send_message(
-            chat_id=ADMIN_ID,
-            text=notification_html,
-            parse_mode=ParseMode.HTML,
-            reply_markup=builder.as_markup(),
-            disable_web_page_preview=True
-        )
+    def __init__(self):
+        self.lags: deque[float] = deque(maxlen=max(1, round(HEALTH_LAG_WINDOW / HEALTH_SAMPLE_INTERVAL)))
+        self.last_update: float | None = None  # monotonic последнего апдейта userbot
+        self.last_send: float | None = None  # monotonic последней успешной отправки ботом
+        self.started = time.monotonic()
+        self.runner = None
+
+    async def sample_loop_lag(self):
+        """Опоздание пробуждения относительно заказанного сна — задержка цикла событий"""
+        while True:
+            expected = time.monotonic() + HEALTH_SAMPLE_INTERVAL
+            await asyncio.sleep(HEALTH_SAMPLE_INTERVAL)
+            self.lags.append(max(0.0, time.monotonic() - expected))
+
+    async def report(self) -> tuple[dict, list[str]]:
+        now = time.monotonic()
+        max_lag = max(self.lags, default=0.0)
+        update_age = now - self.last_update if self.last_update is not None else None
+        send_age = now - self.last_send if self.last_send is not None else None
+        pending = await outbox.pending_count() if outbox.db is not None else None
+        queue = len(batcher.queue)
+
+        problems = []
+        if max_lag > HEALTH_MAX_LOOP_LAG:
+            problems.append("loop_lag")
+        if (update_age if update_age is not None else now - self.started) > HEALTH_MAX_UPDATE_AGE:
+            problems.append("no_updates")
+        # Давность отправки важна только когда есть что отправлять
+        if pending and (send_age if send_age is not None else now - self.started) > HEALTH_MAX_SEND_AGE:
+            problems.append("send_stalled")
+        if queue > HEALTH_MAX_QUEUE:
+            problems.append("queue_depth")
+
+        status = {
+            "status": "degraded" if problems else "ok",
+            "problems": problems,
+            "loop_lag_ms": round(self.lags[-1] * 1000, 1) if self.lags else 0.0,
+            "max_loop_lag_ms": round(max_lag * 1000, 1),
+            "last_update_age": round(update_age, 1) if update_age is not None else None,
+            "last_send_age": round(send_age, 1) if send_age is not None else None,
+            "queue": queue,
+            "albums": len(album_buffer.groups),
+            "outbox_pending": pending,
+            "uptime": round(now - self.started),
+        }
+        return status, problems
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        status, problems = await self.report()
+        return web.json_response(status, status=503 if problems else 200)
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        ready = userbot.is_connected() and outbox.db is not None and not lifecycle.stopping.is_set()
+        return web.json_response({"ready": ready}, status=200 if ready else 503)
+
+    async def start_server(self):
+        app = web.Application()
+        app.router.add_get("/health", self.handle_health)
+        app.router.add_get("/ready", self.handle_ready)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, HEALTH_HOST, HEALTH_PORT).start()
+        logger.info(f"Проверки состояния: http://{HEALTH_HOST}:{HEALTH_PORT}/health и /ready")
+
+    async def stop_server(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+health = HealthMonitor()
+
+
+# ====================== Жизненный цикл ====================== #
+
+class Lifecycle:
+    """Учет фоновых задач и сигнал остановки"""
+    __slots__ = ("tasks", "stopping")
+
+    def __init__(self):
+        self.tasks: set[asyncio.Task] = set()
+        self.stopping = asyncio.Event()
+
+    def spawn(self, coro) -> asyncio.Task:
+        """Запуск фоновой задачи, которая будет отменена и дождана при остановке"""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.on_task_done)
+        return task
+
+    def on_task_done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Фоновая задача завершилась с ошибкой: {task.exception()!r}")
+
+    def request_stop(self, reason: str):
+        if not self.stopping.is_set():
+            logger.info(f"Остановка: {reason}")
+            self.stopping.set()
+
+    def install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            # На Windows обработчики сигналов цикла не поддерживаются
+            with suppress(NotImplementedError):
+                loop.add_signal_handler(sig, self.request_stop, sig.name)
+
+    async def cancel(self, tasks):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+lifecycle = Lifecycle()
+
+async def drain_pipeline():
+    """Дообработка принятых сообщений: альбомы, очередь пакетирования, затем отправка outbox"""
+    album_buffer.flush_all()
+    await batcher.idle.wait()
+    while await outbox.fetch_unsent(1):
+        await asyncio.sleep(0.05)
+
+async def shutdown(polling: asyncio.Task, pipeline: list):
+    """Остановка: прием апдейтов, дообработка не дольше SHUTDOWN_TIMEOUT, закрытие соединений"""
+    # Новые сообщения больше не принимаются; соединение userbot нужно get_sender при дообработке
+    userbot.remove_event_handler(handle_new_message)
+    userbot.remove_event_handler(handle_edited_message)
+    with suppress(RuntimeError):
+        # RuntimeError: опрос еще не начался или уже завершен
+        await dp.stop_polling()
+    await lifecycle.cancel([polling])
+
+    # Догон, сторож соединения и периодические задачи не нужны для дообработки
+    await lifecycle.cancel([task for task in lifecycle.tasks if task not in pipeline])
+
+    try:
+        await asyncio.wait_for(drain_pipeline(), SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Уже записанное в outbox будет отправлено после перезапуска
+        logger.warning(f"Дообработка не уложилась в {SHUTDOWN_TIMEOUT} сек, в очереди {len(batcher.queue)} сообщений")
+    await lifecycle.cancel(list(lifecycle.tasks))
 
+    try:
+        await keyword_counters.flush()
     except Exception as e:
-        logger.error(f"Ошибка отправки уведомления: {e}", exc_info=True)
+        logger.error(f"Ошибка сохранения счетчиков ключевых слов: {e}")
+    await health.stop_server()
+    if loop_profiler.active:
+        loop_profiler.stop()
+    if recorder is not None:
+        recorder.close()
+    await outbox.close()
+    await userbot.disconnect()
+    await bot.session.close()
 
 
 # ====================== Основная функция ====================== #
 
 async def main():
     """Основная функция запуска"""
+    global recorder
     # Инициализация базы данных
     await init_db()
     await load_tracked_data()
+    await load_routes()
+    await load_sender_filters()
+    await load_chat_state()
+    # Неотправленные до перезапуска уведомления будут дочитаны из outbox
+    await outbox.open()
+
+    if RECORD_FILE:
+        recorder = UpdateRecorder(RECORD_FILE)
+        logger.info(f"Запись входящих сообщений в {RECORD_FILE}")
 
     # Запуск компонентов
     await userbot.start()
     logger.info("Userbot успешно запущен")
 
-    # Периодическая обработка оставшихся сообщений
-
-    async def process_pending():
-        while True:
-            if pending_messages:
-                await process_message_batch()
-            await asyncio.sleep(1)
-            
-    asyncio.create_task(process_pending())
-    await dp.start_polling(bot)
+    # Пакетная обработка сообщений по событию поступления; эти задачи дорабатывают при остановке
+    pipeline = [lifecycle.spawn(batcher.run()), lifecycle.spawn(outbox_sender())]
+    lifecycle.spawn(catch_up_missed())
+    lifecycle.spawn(connection_watchdog())
+    lifecycle.spawn(analytics_flusher())
+    lifecycle.spawn(cleanup_loop())
+    if HEALTH_PORT:
+        lifecycle.spawn(health.sample_loop_lag())
+        await health.start_server()
+
+    # Сигналы обрабатываются здесь, а не в aiogram: сессия бота нужна до конца дообработки
+    lifecycle.install_signal_handlers()
+    polling = lifecycle.spawn(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+    polling.add_done_callback(lambda _: lifecycle.request_stop("опрос Bot API завершен"))
+
+    await lifecycle.stopping.wait()
+    await shutdown(polling, pipeline)
     logger.info("Бот остановлен")
 
 
+def run(coro):
+    """Запуск в стандартном цикле asyncio или в uvloop (режим производительности)"""
+    if PERF_MODE:
+        try:
+            import uvloop
+        except ImportError:
+            logger.info("uvloop не установлен, используется стандартный цикл asyncio")
+        else:
+            logger.info("Режим производительности: uvloop")
+            uvloop.run(coro)
+            return
+    asyncio.run(coro)
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replay", metavar="FILE", help="воспроизвести запись RECORD_FILE вместо подключения к Telegram")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение воспроизведения (0 — без пауз)")
+    args = parser.parse_args()
+    run(replay(args.replay, args.speed) if args.replay else main())
\ No newline at end of file
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# main.py читает конфигурацию и создает файл сессии при импорте
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "test")
+os.environ.setdefault("ADMIN_ID", "42")
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.chdir(tempfile.mkdtemp(prefix="tracker-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import main
+from main import BATCH_MAX_WAIT, MessageBatcher
+
+
+def burst(batcher, count):
+    for message_id in range(count):
+        batcher.put(555, message_id)
+
+
+def test_first_message_after_lull_is_not_held():
+    async def check():
+        batcher = MessageBatcher()
+        # Плотный поток ~1000 сообщ./сек: окна закрываются, целевой размер растет
+        for _ in range(60):
+            burst(batcher, 10)
+            await asyncio.sleep(0.01)
+        assert batcher.target_size > 1
+        batcher.queue.clear()
+        # Сдвигаем время последнего сообщения вместо реального ожидания
+        batcher.last_arrival -= 2
+        batcher.window_started -= 2
+        batcher.put(555, 1)
+        assert batcher.target_size == 1
+        assert batcher.ready.is_set()
+
+    asyncio.run(check())
+
+
+def test_steady_trickle_flushes_within_deadline():
+    async def check():
+        flushed = []
+
+        async def fake_batch(batch):
+            flushed.append(len(batch))
+
+        original = main.process_message_batch
+        main.process_message_batch = fake_batch
+        batcher = MessageBatcher()
+        task = asyncio.create_task(batcher.run())
+        try:
+            for message_id in range(3):
+                batcher.put(555, message_id)
+                await asyncio.sleep(0.3)
+            assert flushed == [1, 1, 1]
+        finally:
+            task.cancel()
+            main.process_message_batch = original
+
+    asyncio.run(check())
+
+
+def test_failed_batch_is_retried_in_order():
+    async def check():
+        calls = []
+
+        async def flaky_batch(batch):
+            calls.append([message for _, message, _ in batch])
+            if len(calls) == 1:
+                raise RuntimeError("database is locked")
+
+        original, original_delay = main.process_message_batch, main.BATCH_RETRY_DELAY
+        main.process_message_batch, main.BATCH_RETRY_DELAY = flaky_batch, 0.01
+        batcher = MessageBatcher()
+        try:
+            burst(batcher, 3)
+            await batcher.flush()
+            assert list(message for _, message, _ in batcher.queue) == [0, 1, 2]
+            batcher.put(555, 3)
+            await batcher.flush()
+            assert calls == [[0, 1, 2], [0, 1, 2, 3]]
+            assert not batcher.queue and batcher.failures == 0
+        finally:
+            main.process_message_batch, main.BATCH_RETRY_DELAY = original, original_delay
+
+    asyncio.run(check())
+
+
+def test_burst_tail_is_not_held_until_deadline():
+    async def check():
+        flushed = []
+
+        async def fake_batch(batch):
+            flushed.append((len(batch), time.monotonic() - batch[-1][2]))
+
+        original = main.process_message_batch
+        main.process_message_batch = fake_batch
+        batcher = MessageBatcher()
+        task = asyncio.create_task(batcher.run())
+        try:
+            for _ in range(60):
+                burst(batcher, 10)
+                await asyncio.sleep(0.01)
+            burst(batcher, 5)
+            # Хвост всплеска меньше целевого размера: уходит по паузе, а не по сроку
+            await asyncio.sleep(BATCH_MAX_WAIT)
+            assert not batcher.queue
+            assert flushed[-1][1] < BATCH_MAX_WAIT / 2
+        finally:
+            task.cancel()
+            main.process_message_batch = original
+
+    asyncio.run(check())
@@ -0,0 +1,23 @@
+import asyncio
+import time
+
+from main import KEYWORD_HITS_RETENTION, cleanup_db, db_connect, init_db
+
+
+def test_old_keyword_hits_are_deleted():
+    async def check():
+        await init_db()
+        now_bucket = int(time.time()) // 3600
+        async with db_connect() as db:
+            await db.execute('DELETE FROM keyword_hits')
+            await db.executemany(
+                'INSERT INTO keyword_hits (bucket, chat_id, keyword, hits) VALUES (?, 555, ?, 1)',
+                [(now_bucket - KEYWORD_HITS_RETENTION - 1, "old"), (now_bucket, "new")]
+            )
+            await db.commit()
+        await cleanup_db()
+        async with db_connect() as db:
+            cursor = await db.execute('SELECT keyword FROM keyword_hits')
+            return await cursor.fetchall()
+
+    assert asyncio.run(check()) == [("new",)]
@@ -0,0 +1,17 @@
+from main import FuzzyIndex, fold_homoglyphs
+
+
+def test_lowercase_lookalikes_fold():
+    assert fold_homoglyphs("iPhоnе") == "iphone"  # кириллические о и е
+
+
+def test_non_lookalike_cyrillic_is_kept():
+    assert FuzzyIndex([("вот", 1)]).lookup("bot") is None
+    assert FuzzyIndex([("вот", 1)]).lookup("вод") == "вот"
+
+
+def test_typo_within_distance():
+    index = FuzzyIndex([("iphone", 1), ("samsung", 2)])
+    assert index.lookup("iphome") == "iphone"
+    assert index.lookup("samsong") == "samsung"
+    assert index.lookup("iphxxx") is None
@@ -0,0 +1,31 @@
+import asyncio
+
+from main import db_connect, import_keywords, init_db, parse_keyword_line
+
+CHAT = 777
+
+
+async def lines(*items):
+    for item in items:
+        yield item
+
+
+def test_header_skipped_only_on_first_line():
+    assert parse_keyword_line("keyword", first=True) is None
+    assert parse_keyword_line("keyword") == "keyword"
+    assert parse_keyword_line("iPhone,2", first=True) == "iphone"
+
+
+def test_import_keeps_literal_keyword():
+    async def check():
+        await init_db()
+        async with db_connect() as db:
+            await db.execute('INSERT OR IGNORE INTO chats (id, title) VALUES (?, ?)', (CHAT, "Chat"))
+            await db.execute('DELETE FROM keywords WHERE chat_id = ?', (CHAT,))
+            await db.commit()
+        added = await import_keywords(CHAT, lines("keyword", "iphone", "# comment", "keyword", "sale"))
+        async with db_connect() as db:
+            cursor = await db.execute('SELECT keyword FROM keywords WHERE chat_id = ? ORDER BY keyword', (CHAT,))
+            return added, [row[0] for row in await cursor.fetchall()]
+
+    assert asyncio.run(check()) == (3, ["iphone", "keyword", "sale"])
@@ -0,0 +1,74 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+from telethon.tl.types import PeerChannel, PeerChat, PeerUser
+from telethon.utils import get_peer_id
+
+import main
+from main import CHANNEL_ID_OFFSET, normalize_chat_id
+
+# Свойства проверяются на случайных ID с фиксированным зерном и на границах диапазонов
+SAMPLES = 10_000
+MAX_BARE_ID = CHANNEL_ID_OFFSET - 1
+
+
+def sample_ids(seed: int) -> list[int]:
+    rng = random.Random(seed)
+    edges = [1, 2, 10**9, 2**31 - 1, 2**31, MAX_BARE_ID]
+    return edges + [rng.randint(1, MAX_BARE_ID) for _ in range(SAMPLES)]
+
+
+def test_marked_channel_maps_to_bare_id():
+    for channel_id in sample_ids(1):
+        assert normalize_chat_id(get_peer_id(PeerChannel(channel_id))) == channel_id, channel_id
+
+
+def test_basic_group_stays_negative():
+    for chat_id in sample_ids(2):
+        marked = get_peer_id(PeerChat(chat_id))
+        assert normalize_chat_id(marked) == marked == -chat_id, chat_id
+
+
+def test_user_unchanged():
+    for user_id in sample_ids(3):
+        assert normalize_chat_id(get_peer_id(PeerUser(user_id))) == user_id, user_id
+
+
+def test_idempotent():
+    for chat_id in sample_ids(4):
+        for marked in (get_peer_id(PeerChannel(chat_id)), -chat_id, chat_id):
+            once = normalize_chat_id(marked)
+            assert normalize_chat_id(once) == once, marked
+
+
+def test_offset_boundary():
+    # -10**12 — еще не канал; первый помеченный канал — -(10**12 + 1)
+    assert normalize_chat_id(-CHANNEL_ID_OFFSET) == -CHANNEL_ID_OFFSET
+    assert normalize_chat_id(-CHANNEL_ID_OFFSET - 1) == 1
+    assert normalize_chat_id(-CHANNEL_ID_OFFSET + 1) == -CHANNEL_ID_OFFSET + 1
+
+
+def test_basic_group_with_100_prefix():
+    # Строковая проверка startswith('-100') портила такие ID обычных групп
+    assert normalize_chat_id(-1001234) == -1001234
+
+
+def test_user_peer_does_not_match_tracked_channel():
+    # Канал X и пользователь X нормализуются одинаково — личный чат отсекается в обработчике
+    channel_id = 555
+    assert normalize_chat_id(get_peer_id(PeerUser(channel_id))) == normalize_chat_id(get_peer_id(PeerChannel(channel_id)))
+    main.tracked_chats.add(main.TrackedChat(main.ChatId(channel_id), "Chat", None))
+    main.batcher.queue.clear()
+    try:
+        for peer in (PeerUser(channel_id), PeerChannel(channel_id)):
+            event = SimpleNamespace(
+                chat_id=get_peer_id(peer), sender_id=1,
+                message=SimpleNamespace(id=1, grouped_id=None)
+            )
+            asyncio.run(main.handle_new_message(event))
+            asyncio.run(main.handle_edited_message(event))
+        assert len(main.batcher.queue) == 2
+    finally:
+        main.batcher.queue.clear()
+        main.tracked_chats.remove(main.ChatId(channel_id))
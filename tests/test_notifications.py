@@ -0,0 +1,8 @@
+from main import ChatId, NotificationTemplate, TrackedChat
+
+
+def test_render_escapes_keywords():
+    template = NotificationTemplate(TrackedChat(ChatId(555), "Chat", None))
+    notification_html, link = template.render(7, "Ann", ["a<b", "at&t"], "excerpt")
+    assert "<b>Ключевые слова:</b> a&lt;b, at&amp;t\n" in notification_html
+    assert link.endswith("/7")
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+from main import OUTBOX_MAX_ATTEMPTS, Outbox, db_connect, init_db
+
+
+def row(message_id, target_id=42, created_at=None):
+    return (555, message_id, 0, target_id, 0, "text", "link", created_at or time.time())
+
+
+async def with_outbox(check):
+    await init_db()
+    async with db_connect() as db:
+        await db.execute('DELETE FROM outbox')
+        await db.execute('DELETE FROM chat_state')
+        await db.commit()
+    outbox = Outbox()
+    await outbox.open()
+    try:
+        await check(outbox)
+    finally:
+        await outbox.close()
+
+
+def test_failed_put_many_rolls_back():
+    async def check(outbox):
+        with pytest.raises(Exception):
+            # Вторая строка короче — executemany падает после первой
+            await outbox.put_many([row(1), row(2)[:3]], [(555, 2)])
+        await outbox.put_many([], [(556, 1)])
+        async with db_connect() as db:
+            cursor = await db.execute('SELECT COUNT(*) FROM outbox')
+            assert (await cursor.fetchone())[0] == 0
+            cursor = await db.execute('SELECT chat_id FROM chat_state')
+            assert await cursor.fetchall() == [(556,)]
+
+    asyncio.run(with_outbox(check))
+
+
+def test_concurrent_put_and_ack_keep_transactions_whole():
+    async def check(outbox):
+        await outbox.put_many([row(i) for i in range(1, 51)])
+        rows = await outbox.fetch_unsent(50)
+        await asyncio.gather(
+            outbox.put_many([row(i) for i in range(100, 300)], [(555, 299)]),
+            outbox.ack([outbox_id for outbox_id, *_ in rows], []),
+        )
+        assert await outbox.pending_count() == 200
+
+    asyncio.run(with_outbox(check))
+
+
+def test_exhausted_rows_are_logged_and_pruned(caplog):
+    async def check(outbox):
+        await outbox.put_many([row(1, created_at=time.time() - main.OUTBOX_RETENTION - 10)])
+        (outbox_id, *_), = await outbox.fetch_unsent(1)
+        for _ in range(OUTBOX_MAX_ATTEMPTS):
+            await outbox.ack([], [outbox_id])
+        assert await outbox.fetch_unsent(1) == []
+        assert any(f"#{outbox_id}" in record.message for record in caplog.records)
+        await outbox.prune()
+        async with db_connect() as db:
+            cursor = await db.execute('SELECT COUNT(*) FROM outbox')
+            assert (await cursor.fetchone())[0] == 0
+
+    asyncio.run(with_outbox(check))
@@ -0,0 +1,130 @@
+import asyncio
+import datetime
+import re
+from types import SimpleNamespace
+
+import main
+from main import ChatId, TrackedChat, db_connect, init_db, process_message_batch
+
+CHAT = ChatId(555)
+
+
+class FakeMessage:
+    def __init__(self, message_id, text, edit_date=None, grouped_id=None):
+        self.id = message_id
+        self.text = text
+        self.media = None
+        self.edit_date = edit_date
+        self.grouped_id = grouped_id
+
+    async def get_sender(self):
+        return SimpleNamespace(first_name="Ann", username=None)
+
+
+class FailingMessage(FakeMessage):
+    async def get_sender(self):
+        raise ConnectionError("sender lookup failed")
+
+
+async def run_pipeline(*batches):
+    await init_db()
+    async with db_connect() as db:
+        await db.execute('DELETE FROM outbox')
+        await db.commit()
+    main.tracked_chats.remove(CHAT)
+    main.tracked_chats.add(TrackedChat(CHAT, "Chat", None))
+    main.tracked_chats.set_pattern(CHAT, re.compile(r'\b(alpha|beta)\b', re.IGNORECASE))
+    main.hit_cache = main.HitCache(100)
+    main.last_seen_ids.pop(CHAT, None)
+    main.message_retries = main.MessageRetries()
+    await main.outbox.open()
+    try:
+        for batch in batches:
+            await process_message_batch([(CHAT, message, 0.0) for message in batch])
+        async with db_connect() as db:
+            cursor = await db.execute('SELECT message_id, revision, text FROM outbox ORDER BY id')
+            return await cursor.fetchall()
+    finally:
+        await main.outbox.close()
+
+
+def test_edits_within_one_second_are_all_notified():
+    edited = datetime.datetime(2026, 1, 1, 12, 0, 0)
+    rows = asyncio.run(run_pipeline(
+        [FakeMessage(1, "nothing yet")],
+        [FakeMessage(1, "now alpha", edited)],
+        [FakeMessage(1, "now alpha and beta", edited)],
+    ))
+    assert len(rows) == 2
+    assert "alpha" in rows[0][2] and "beta" not in rows[0][2].split("Сообщение")[0]
+    assert "beta" in rows[1][2].split("Сообщение")[0]
+    assert rows[0][1] != rows[1][1]
+
+
+def test_unchanged_edit_is_not_renotified():
+    edited = datetime.datetime(2026, 1, 1, 12, 0, 0)
+    rows = asyncio.run(run_pipeline(
+        [FakeMessage(1, "alpha")],
+        [FakeMessage(1, "alpha", edited)],
+    ))
+    assert len(rows) == 1
+
+
+def test_album_progress_uses_last_part():
+    album = main.AlbumMessage([FakeMessage(12, None, grouped_id=7), FakeMessage(10, "alpha", grouped_id=7)])
+    rows = asyncio.run(run_pipeline([album]))
+    assert [row[0] for row in rows] == [10]
+    assert main.last_seen_ids[CHAT] == 12
+
+
+def test_progress_waits_for_open_album():
+    async def scenario():
+        main.album_buffer.put(CHAT, FakeMessage(20, "beta", grouped_id=9))
+        try:
+            await run_pipeline([FakeMessage(19, "nothing"), FakeMessage(21, "nothing")])
+            return main.last_seen_ids[CHAT]
+        finally:
+            parts, handle = main.album_buffer.groups.pop((CHAT, 9))
+            handle.cancel()
+
+    assert asyncio.run(scenario()) == 19
+
+
+def test_failed_message_holds_progress_until_retried():
+    async def scenario():
+        first = await run_pipeline([FakeMessage(9, "nothing"), FailingMessage(10, "alpha"), FakeMessage(11, "beta")])
+        held = (main.last_seen_ids[CHAT], main.message_retries.floor(CHAT))
+        # Повтор: то же сообщение, на этот раз успешно
+        await main.outbox.open()
+        try:
+            await process_message_batch([(CHAT, FakeMessage(10, "alpha"), 0.0), (CHAT, FakeMessage(12, "nothing"), 0.0)])
+        finally:
+            await main.outbox.close()
+        return first, held, main.last_seen_ids[CHAT], main.message_retries.floor(CHAT)
+
+    first, held, progress, floor = asyncio.run(scenario())
+    assert [row[0] for row in first] == [11]
+    assert held == (9, 10)
+    assert progress == 12 and floor is None
+
+
+def test_edit_of_album_part_is_not_renotified():
+    edited = datetime.datetime(2026, 1, 1, 12, 0, 0)
+    album = main.AlbumMessage([FakeMessage(10, "alpha here", grouped_id=7), FakeMessage(11, "alpah too", grouped_id=7)])
+    rows = asyncio.run(run_pipeline([album], [FakeMessage(11, "alpha too", edited, grouped_id=7)]))
+    assert [row[0] for row in rows] == [10]
+
+
+def test_stats_count_messages_that_are_not_scanned():
+    main.tracked_chats.remove(CHAT)
+    main.tracked_chats.add(TrackedChat(CHAT, "Chat", None))
+    main.chat_stats.pop(CHAT, None)
+    marked = -(main.CHANNEL_ID_OFFSET + CHAT)
+    try:
+        # Медиа без подписи и правка без изменений до матчинга не доходят, но в нагрузку входят
+        media = SimpleNamespace(chat_id=marked, sender_id=1, message=FakeMessage(1, None))
+        asyncio.run(main.handle_new_message(media))
+        asyncio.run(main.handle_edited_message(media))
+        assert main.chat_stats[CHAT].totals() == (2, 0, 0.0)
+    finally:
+        main.batcher.queue.clear()
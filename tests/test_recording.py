@@ -0,0 +1,48 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import main
+from main import ChatId, ReplayEvent, TrackedChat, UpdateRecorder, iter_recording
+
+TRACKED = ChatId(555)
+
+
+def event(chat_id, message_id, text):
+    message = SimpleNamespace(
+        id=message_id, text=text, date=datetime.datetime(2026, 1, 1), media=None, grouped_id=None,
+        sender_id=7, sender=SimpleNamespace(first_name="Ann", username="ann"),
+    )
+    return SimpleNamespace(chat_id=chat_id, sender_id=7, message=message)
+
+
+def record(tmp_path, record_all):
+    path = str(tmp_path / "updates.jsonl.gz")
+    main.tracked_chats.add(TrackedChat(TRACKED, "Chat", None))
+    main.recorder = UpdateRecorder(path)
+    main.RECORD_ALL_CHATS = record_all
+
+    async def feed():
+        await main.handle_new_message(event(-1000000000555, 1, "in tracked chat"))
+        await main.handle_new_message(event(99, 2, "private message"))
+
+    try:
+        asyncio.run(feed())
+    finally:
+        main.recorder.close()
+        main.recorder = None
+        main.RECORD_ALL_CHATS = False
+        main.batcher.queue.clear()
+    return list(iter_recording(path))
+
+
+def test_only_tracked_chats_are_recorded(tmp_path):
+    records = record(tmp_path, record_all=False)
+    assert [r["message_id"] for r in records] == [1]
+    replayed = ReplayEvent(records[0])
+    assert replayed.message.text == "in tracked chat"
+    assert replayed.message.sender.username == "ann"
+
+
+def test_full_capture_is_opt_in(tmp_path):
+    assert [r["message_id"] for r in record(tmp_path, record_all=True)] == [1, 2]
@@ -0,0 +1,30 @@
+from main import DEFAULT_DESTINATION, ChatId, RouteTable
+
+CHAT = ChatId(555)
+TEAM = (-100777, 0)
+
+
+def test_no_routes_go_to_default():
+    assert RouteTable().resolve(CHAT, {"alpha"}) == {DEFAULT_DESTINATION: {"alpha"}}
+
+
+def test_unrouted_keyword_falls_back_per_keyword():
+    table = RouteTable()
+    table.add(TEAM, None, "alpha")
+    assert table.resolve(CHAT, {"alpha", "gamma"}) == {TEAM: {"alpha"}, DEFAULT_DESTINATION: {"gamma"}}
+
+
+def test_chat_keyword_route():
+    table = RouteTable()
+    table.add(TEAM, CHAT, "alpha")
+    assert table.resolve(CHAT, {"alpha"}) == {TEAM: {"alpha"}}
+    assert table.resolve(ChatId(556), {"alpha"}) == {DEFAULT_DESTINATION: {"alpha"}}
+
+
+def test_chat_and_catch_all_routes_receive_every_keyword():
+    table = RouteTable()
+    table.add(TEAM, CHAT, None)
+    table.add((1, 5), None, "alpha")
+    assert table.resolve(CHAT, {"alpha", "gamma"}) == {TEAM: {"alpha", "gamma"}, (1, 5): {"alpha"}}
+    table.add((2, 0), None, None)
+    assert table.resolve(ChatId(556), {"gamma"}) == {(2, 0): {"gamma"}}
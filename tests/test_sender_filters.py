@@ -0,0 +1,43 @@
+from main import GLOBAL_SCOPE, SenderFilters
+
+
+def make(*rules):
+    filters = SenderFilters()
+    for chat_id, sender_id, mode in rules:
+        filters.add(chat_id, sender_id, mode)
+    return filters
+
+
+def test_no_rules_pass_everyone():
+    assert not make().is_blocked(555, 1)
+
+
+def test_chat_allow_rules_act_as_allowlist():
+    filters = make((555, 1, "allow"))
+    assert not filters.is_blocked(555, 1)
+    assert filters.is_blocked(555, 2)
+    assert filters.is_blocked(555, None)
+    # Другие чаты разрешающий список не затрагивает
+    assert not filters.is_blocked(777, 2)
+
+
+def test_global_allow_rules_act_as_allowlist():
+    filters = make((GLOBAL_SCOPE, 1, "allow"))
+    assert not filters.is_blocked(555, 1)
+    assert filters.is_blocked(555, 2)
+
+
+def test_chat_rules_override_global():
+    filters = make((GLOBAL_SCOPE, 1, "block"), (555, 1, "allow"), (GLOBAL_SCOPE, 3, "allow"), (777, 2, "block"))
+    assert not filters.is_blocked(555, 1)
+    assert filters.is_blocked(777, 1)
+    assert filters.is_blocked(777, 2)
+    assert not filters.is_blocked(777, 3)
+
+
+def test_block_rules():
+    filters = make((555, 1, "block"), (GLOBAL_SCOPE, 2, "block"))
+    assert filters.is_blocked(555, 1)
+    assert filters.is_blocked(555, 2)
+    assert not filters.is_blocked(555, 3)
+    assert not filters.is_blocked(777, 1)